@@ -3,10 +3,18 @@ import os
 
 # ワーカー設定
 workers = 2
-worker_class = 'sync'
+# ASGI（uvicorn）で動かす。SSE・バトンパスなどの非同期ビューは、待っている間スレッドを使わない
+# 従来どおり WSGI をスレッドで動かす場合は GUNICORN_WORKER_CLASS=gthread にする
+# （SSE も流れるが、接続ごとにスレッドを1つ使うので threads を超える同時接続は待たされる）
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'uvicorn_worker.UvicornWorker')
+if worker_class == 'gthread':
+    wsgi_app = 'relay_manga.wsgi:application'
+    threads = 8
+else:
+    wsgi_app = 'relay_manga.asgi:application'
 
-# タイムアウト設定（AI画像生成用に延長）
-timeout = 180  # 3分（AI画像生成は30秒〜2分かかる可能性がある）
+# タイムアウト設定（AI画像生成は run_ai_worker で処理するので、リクエストは長く待たない）
+timeout = 30
 graceful_timeout = 30
 keepalive = 5
 
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Manga, Page, UserProfile, Baton
+from . import pages
+from .models import Manga, Page, PageLike, UserProfile, Baton, AIGenerationJob, AIDraft, OutgoingEmail
+from .tree import bump_tree_version
 
 @admin.register(Manga)
 class MangaAdmin(admin.ModelAdmin):
@@ -8,6 +10,27 @@ class MangaAdmin(admin.ModelAdmin):
 @admin.register(Page)
 class PageAdmin(admin.ModelAdmin):
     list_display = ('id', 'manga', 'author', 'created_at', 'parent', 'title')
+    # 祖先パス・深さ・祖先の集計は add_page とシグナルが保つ
+    maintained_fields = ('path', 'depth', 'subtree_priority', 'descendant_count')
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            return self.maintained_fields
+        # 付け替えやうぃーね数の書き換えは祖先パスと集計に反映できないので、追加した後は変えさせない
+        return ('manga', 'parent', 'likes') + self.maintained_fields
+
+    def save_model(self, request, obj, form, change):
+        # 追加するときは画面からのページ作成と同じく、祖先の集計やバトンの完了もまとめて行う
+        if change:
+            super().save_model(request, obj, form, change)
+            # タイトルや画像はツリービューの JSON に入っているので作り直させる
+            bump_tree_version(obj.manga_id)
+        else:
+            pages.add_page(obj, obj.manga, obj.author, obj.parent)
+
+@admin.register(PageLike)
+class PageLikeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'page', 'user', 'session_key', 'created_at')
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -18,4 +41,22 @@ class UserProfileAdmin(admin.ModelAdmin):
 class BatonAdmin(admin.ModelAdmin):
     list_display = ('id', 'from_user', 'to_user', 'page', 'created_at', 'is_completed')
     list_filter = ('is_completed', 'created_at')
-    search_fields = ('from_user__username', 'to_user__username')
\ No newline at end of file
+    search_fields = ('from_user__username', 'to_user__username')
+
+@admin.register(AIGenerationJob)
+class AIGenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'parent', 'status', 'progress', 'candidates', 'created_at', 'finished_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('user__username', 'prompt')
+    exclude = ('partial_image',)
+
+@admin.register(AIDraft)
+class AIDraftAdmin(admin.ModelAdmin):
+    list_display = ('id', 'job', 'page', 'created_at')
+    list_filter = ('created_at',)
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'to_email', 'subject', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('to_email', 'subject')
@@ -0,0 +1,134 @@
+"""
+AI画像生成の受付制御
+
+- 受付時：ユーザーごとのトークンバケット（AI_USER_BURST 回まで連続、以降は AI_USER_RATE_PER_HOUR の割合で回復）と
+  待機中ジョブ数の上限で、使いすぎのユーザーをすぐに断る
+- 実行時：共有キャッシュのスロット（AI_MAX_CONCURRENT 個）と全体のトークンバケット（AI_GLOBAL_RATE_PER_MINUTE）で、
+  すべてのワーカーを合わせた同時実行数と上流APIへのリクエスト頻度を抑える
+
+上限を超えたジョブは失敗させずに待たせ、待ち順と待ち時間の目安を返す。
+スロットとバケットはキャッシュに置くので、REDIS_URL の設定が必要（なければ checks が起動時にエラーにする）。
+"""
+import math
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+USER_BUCKET_KEY = "ai:bucket:user:{user_id}"
+GLOBAL_BUCKET_KEY = "ai:bucket:global"
+SLOT_KEY = "ai:slot:{index}"
+AVERAGE_DURATION_KEY = "ai:average-duration"
+
+
+@contextmanager
+def cache_lock(key):
+    """
+    キャッシュのキーを使った短いロック（取れなければ少し待って再試行）
+    取れたかどうかを with ... as で受け取る（取れなくても処理は続けられるようにしておく）
+    """
+    lock_key = f"{key}:lock"
+    acquired = False
+    for _ in range(50):
+        if cache.add(lock_key, 1, timeout=5):
+            acquired = True
+            break
+        time.sleep(0.01)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(lock_key)
+
+
+def take_token(key, capacity, per_second, cost=1):
+    """
+    トークンバケットから cost 個取る
+    取れたら 0、取れなければ次に取れるまでの秒数を返す
+    """
+    cost = min(cost, capacity)
+    with cache_lock(key) as acquired:
+        if not acquired:
+            return 1
+        now = time.time()
+        tokens, updated_at = cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * per_second)
+        if tokens < cost:
+            return math.ceil((cost - tokens) / per_second)
+        cache.set(key, (tokens - cost, now), timeout=None)
+        return 0
+
+
+def give_back_token(key, capacity):
+    """取ったトークンを使わなかったときに戻す"""
+    with cache_lock(key) as acquired:
+        if not acquired:
+            return
+        tokens, updated_at = cache.get(key, (capacity, time.time()))
+        cache.set(key, (min(capacity, tokens + 1), updated_at), timeout=None)
+
+
+def admit(user, queued_count, candidates=1):
+    """
+    生成ジョブを受け付けてよいか判定する（候補の枚数分のトークンを使う）
+    受け付けるなら None、断るなら (エラーメッセージ, 再試行までの秒数) を返す
+    """
+    if queued_count >= settings.AI_MAX_QUEUED_PER_USER:
+        return '生成待ちの画像が多すぎます。今の生成が終わってから試してください。', 0
+
+    retry_after = take_token(
+        USER_BUCKET_KEY.format(user_id=user.id),
+        settings.AI_USER_BURST,
+        settings.AI_USER_RATE_PER_HOUR / 3600,
+        cost=candidates,
+    )
+    if retry_after:
+        minutes = math.ceil(retry_after / 60)
+        return f'AI生成の回数が上限に達しました。約{minutes}分後に再試行してください。', retry_after
+    return None
+
+
+def take_global_token():
+    """上流APIへ1回リクエストしてよいか（AI_GLOBAL_RATE_PER_MINUTE が 0 なら常に True）"""
+    rate = settings.AI_GLOBAL_RATE_PER_MINUTE
+    if rate <= 0:
+        return True
+    return take_token(GLOBAL_BUCKET_KEY, rate, rate / 60) == 0
+
+
+def give_back_global_token():
+    rate = settings.AI_GLOBAL_RATE_PER_MINUTE
+    if rate > 0:
+        give_back_token(GLOBAL_BUCKET_KEY, rate)
+
+
+def acquire_slot():
+    """
+    全ワーカー共通の実行枠を1つ取り、(番号, トークン) を返す（空きがなければ None）
+    枠は AI_JOB_TIMEOUT で切れるので、ワーカーが落ちても戻ってくる
+    """
+    token = uuid.uuid4().hex
+    for index in range(settings.AI_MAX_CONCURRENT):
+        if cache.add(SLOT_KEY.format(index=index), token, timeout=settings.AI_JOB_TIMEOUT):
+            return index, token
+    return None
+
+
+def release_slot(slot):
+    """
+    取った実行枠を返す
+    時間切れで切れた枠はもう別のジョブのものかもしれないので、自分のトークンのときだけ消す
+    """
+    index, token = slot
+    key = SLOT_KEY.format(index=index)
+    with cache_lock(key) as acquired:
+        if acquired and cache.get(key) == token:
+            cache.delete(key)
+
+
+def estimated_wait(position, average_duration):
+    """前に position 件待っているときの待ち時間の目安（秒）"""
+    rounds = position // max(settings.AI_MAX_CONCURRENT, 1) + 1
+    return int(rounds * average_duration)
@@ -0,0 +1,536 @@
+"""
+AI画像生成
+
+生成には30秒〜2分かかるので、リクエストの中では待たない。
+ビューは AIGenerationJob を登録してすぐに job id を返し、
+ワーカープロセス（python manage.py run_ai_worker）が DB をキューとして順に処理する。
+ブラウザはステータスAPIをポーリングして進捗と結果を受け取る。
+
+stream=True のジョブでは部分画像を受け取るたびにジョブへ保存し、
+ブラウザは Server-Sent Events（job_events）で届いた順に受け取って表示する。
+ASGI では非同期ジェネレータ（ajob_events）で流すので、待っている間スレッドを使わない。
+
+生成画像は候補ごとに下書き（AIDraft）として保存し（本番は Cloudinary、置き場所は draft_stores）、
+ブラウザにはプレビューURLと下書きIDだけを返す。continue_page に下書きIDを渡せば、画像が
+ブラウザを往復せずにそのままページになる（未使用の下書きは AI_DRAFT_TTL 後に消す）。
+
+生成そのものは settings.AI_BACKEND のバックエンド（ai_backends）が行う。
+バックエンドと参照画像を取りに行く HTTP セッションはプロセスで1つずつ使い回し、
+参照画像はメモリ上の LRU キャッシュに置いて、同じページでやり直すときは取りに行かない。
+
+受付・同時実行数の制御は admission を参照。待機中のジョブはユーザーごとに交互に処理する。
+同じユーザーが同じ内容で生成しようとしたときは、進行中または完了済みの同じジョブを返す（dedup_key）。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import timedelta
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count, F, Q, Subquery, Window
+from django.db.models.functions import Coalesce, RowNumber
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import admission
+from .models import AIDraft, AIGenerationJob
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_backend = None
+_draft_store = None
+_http = None
+_references = OrderedDict()  # (page_id, url) -> 画像のバイト列（古い順）
+_reference_bytes = 0
+
+PROMPT_TEMPLATE = """これは漫画の続きのページです。
+前のページの続きとして自然につながるように描いてください。
+
+ユーザーの指示: {prompt}
+
+要件:
+- 正方形の画像（1024x1024px）
+- マンガ風のスタイル
+- 前のページの画風や連続性を保つ
+- セリフやテキストは含めない（吹き出しの枠だけはOK）"""
+
+
+def build_prompt(prompt):
+    return PROMPT_TEMPLATE.format(prompt=prompt)
+
+
+def user_error_message(error):
+    """よくあるエラーの日本語化"""
+    error_message = str(error)
+    if 'safety system' in error_message:
+        return 'プロンプトに不適切な単語が含まれています。修正してやり直してください。'
+    if 'rate_limit' in error_message.lower():
+        return 'APIのレート制限に達しました。しばらく待ってから再試行してください。'
+    if 'timeout' in error_message.lower():
+        return 'タイムアウトしました。もう一度試してください。'
+    return f'エラーが発生しました。サイト管理者に伝えてください: {error_message}'
+
+
+def get_backend():
+    """settings.AI_BACKEND の生成バックエンド（プロセスで1つを使い回す）"""
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = import_string(settings.AI_BACKEND)()
+        return _backend
+
+
+def get_draft_store():
+    """
+    下書きの置き場所（draft_stores）。プロセスで1つを使い回す
+    settings.AI_DRAFT_STORE がなければ、バックエンドの DRAFT_STORE を使う
+    """
+    global _draft_store
+    backend = get_backend()
+    with _lock:
+        if _draft_store is None:
+            _draft_store = import_string(settings.AI_DRAFT_STORE or backend.DRAFT_STORE)()
+        return _draft_store
+
+
+def _get_http():
+    """参照画像の取得に使う、プロセスで共有する HTTP セッション"""
+    global _http
+    with _lock:
+        if _http is None:
+            _http = httpx.Client(
+                timeout=settings.AI_REFERENCE_TIMEOUT,
+                limits=httpx.Limits(max_keepalive_connections=settings.AI_WORKER_CONCURRENCY),
+                follow_redirects=True,
+            )
+        return _http
+
+
+def reference_image(page_id, url):
+    """
+    参照画像（前のページ）のバイト列を返す
+    Cloudinary の URL には画像のバージョン（/v123/）が入るので、
+    (ページID, URL) をキーにすれば画像が差し替わったときは別のキーになる
+    """
+    key = (page_id, url)
+    with _lock:
+        data = _references.get(key)
+        if data is not None:
+            _references.move_to_end(key)
+            return data
+
+    response = _get_http().get(url)
+    response.raise_for_status()
+    data = response.content
+    _remember_reference(key, data)
+    return data
+
+
+def _remember_reference(key, data):
+    """AI_REFERENCE_CACHE_BYTES を超えたら、使われていない順に捨てる"""
+    global _reference_bytes
+    limit = settings.AI_REFERENCE_CACHE_BYTES
+    if len(data) > limit:
+        return
+    with _lock:
+        if key in _references:
+            return
+        _references[key] = data
+        _reference_bytes += len(data)
+        while _reference_bytes > limit:
+            _, evicted = _references.popitem(last=False)
+            _reference_bytes -= len(evicted)
+
+
+def dedup_key(parent_id, prompt, reference_url="", candidates=1):
+    """
+    同じ内容の生成リクエストに同じ値を返すキー
+    プロンプトは全角・半角と空白の違いをならし、参照画像は URL（画像のバージョンを含む）で区別する
+    下書きは親ページごとにしか使えないので、参照画像を使わないときも親ページで区別する
+    """
+    normalized = " ".join(unicodedata.normalize('NFKC', prompt).split())
+    content = json.dumps(
+        [parent_id, normalized, reference_url, candidates, settings.AI_BACKEND, PROMPT_TEMPLATE],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def find_duplicate(user, parent, key):
+    """
+    同じユーザー・同じ親ページの同じ内容のジョブのうち、使い回せるものを返す（なければ None）
+    - 待機中・生成中のもの：同じジョブの結果を待てばよい（上流APIは1回しか呼ばない）
+    - AI_RESULT_CACHE_TTL 秒以内に完了し、まだページに使っていない下書き
+    """
+    since = timezone.now() - timedelta(seconds=settings.AI_RESULT_CACHE_TTL)
+    return (
+        AIGenerationJob.objects.filter(user=user, parent=parent, dedup_key=key)
+        .filter(
+            Q(status__in=[AIGenerationJob.STATUS_QUEUED, AIGenerationJob.STATUS_RUNNING])
+            | Q(
+                status=AIGenerationJob.STATUS_SUCCEEDED,
+                finished_at__gte=since,
+                drafts__page__isnull=True,
+            )
+        )
+        .order_by('-created_at')
+        .distinct()
+        .first()
+    )
+
+
+def enqueue(user, parent, prompt, use_reference, reference_url="", stream=False, key="", candidates=1):
+    """生成ジョブを登録する（実際の生成はワーカーが行う）"""
+    return AIGenerationJob.objects.create(
+        user=user,
+        parent=parent,
+        prompt=prompt,
+        use_reference=use_reference,
+        reference_url=reference_url if use_reference else "",
+        # 部分画像を流せるのは候補が1枚のときだけ
+        stream=stream and candidates == 1,
+        dedup_key=key,
+        candidates=candidates,
+    )
+
+
+def pending_count(user):
+    """ユーザーの待機中・生成中のジョブ数"""
+    return AIGenerationJob.objects.filter(
+        user=user,
+        status__in=[AIGenerationJob.STATUS_QUEUED, AIGenerationJob.STATUS_RUNNING],
+    ).count()
+
+
+def _queued_in_turn_order(queued):
+    """
+    待機中のジョブを順番が回ってくる順に並べる
+    ユーザーごとに何番目のジョブか（turn）を先に比べるので、
+    1人がまとめて登録しても他のユーザーのジョブと交互に処理される
+    """
+    return queued.annotate(
+        turn=Window(
+            RowNumber(),
+            partition_by=[F('user_id')],
+            order_by=[F('created_at').asc(), F('id').asc()],
+        )
+    ).order_by('turn', 'created_at', 'id')
+
+
+def queue_position(job):
+    """
+    自分より前に処理される待機中のジョブの数（待機中でなければ 0）
+    自分の turn より前の turn のジョブと、同じ turn で先に登録されたジョブを1回の COUNT で数える
+    """
+    if job.status != AIGenerationJob.STATUS_QUEUED:
+        return 0
+    queued = AIGenerationJob.objects.filter(status=AIGenerationJob.STATUS_QUEUED)
+    earlier = Q(created_at__lt=job.created_at) | Q(created_at=job.created_at, id__lt=job.id)
+    # 自分の turn（同じユーザーの先に登録された待機中のジョブの数 + 1）
+    turn = Coalesce(
+        Subquery(
+            queued.filter(earlier, user_id=job.user_id)
+            .order_by()
+            .values('user_id')
+            .annotate(count=Count('id'))
+            .values('count')
+        ),
+        0,
+    ) + 1
+    return (
+        _queued_in_turn_order(queued)
+        .filter(Q(turn__lt=turn) | Q(earlier, turn=turn))
+        .order_by()
+        .count()
+    )
+
+
+def average_duration():
+    """最近のジョブの平均生成時間（秒）。1分キャッシュする"""
+    value = cache.get(admission.AVERAGE_DURATION_KEY)
+    if value is None:
+        recent = (
+            AIGenerationJob.objects.filter(
+                status=AIGenerationJob.STATUS_SUCCEEDED, started_at__isnull=False
+            )
+            .order_by('-finished_at')
+            .values_list('started_at', 'finished_at')[:20]
+        )
+        durations = [(finished - started).total_seconds() for started, finished in recent]
+        value = sum(durations) / len(durations) if durations else settings.AI_DEFAULT_DURATION
+        cache.set(admission.AVERAGE_DURATION_KEY, value, 60)
+    return value
+
+
+def claim_next_job():
+    """
+    次に順番が回ってくるジョブを running にして返す。なければ None
+    すでに AI_MAX_RUNNING_PER_USER 件を生成中のユーザーのジョブは後回しにする
+    status を条件にした UPDATE で取り合うので、ワーカーが複数いても同じジョブを二重に処理しない
+    """
+    busy_users = (
+        AIGenerationJob.objects.filter(status=AIGenerationJob.STATUS_RUNNING)
+        .values('user_id')
+        .annotate(running=Count('id'))
+        .filter(running__gte=settings.AI_MAX_RUNNING_PER_USER)
+        .values('user_id')
+    )
+    queued = AIGenerationJob.objects.filter(status=AIGenerationJob.STATUS_QUEUED)
+    while True:
+        job_id = (
+            _queued_in_turn_order(queued.exclude(user_id__in=busy_users))
+            .values_list('id', flat=True)
+            .first()
+        )
+        if job_id is None:
+            return None
+        claimed = queued.filter(pk=job_id).update(
+            status=AIGenerationJob.STATUS_RUNNING,
+            progress=10,
+            started_at=timezone.now(),
+        )
+        if claimed:
+            return AIGenerationJob.objects.get(pk=job_id)
+
+
+def fail_stale_jobs(timeout):
+    """
+    running のまま timeout 秒を過ぎたジョブを失敗にする
+    （処理中にワーカーが落ちたジョブがいつまでも終わらないのを防ぐ）
+    """
+    limit = timezone.now() - timedelta(seconds=timeout)
+    return AIGenerationJob.objects.filter(
+        status=AIGenerationJob.STATUS_RUNNING, started_at__lt=limit
+    ).update(
+        status=AIGenerationJob.STATUS_FAILED,
+        error='タイムアウトしました。もう一度試してください。',
+        finished_at=timezone.now(),
+    )
+
+
+def run_job(job, slot=None):
+    """
+    ジョブを1件処理して結果を保存する（ワーカーのスレッドから呼ばれる）
+    slot は admission.acquire_slot で取った実行枠で、終わったら返す
+    終わる前に fail_stale_jobs で失敗にされていたら、結果は保存しない
+    """
+    logger.info(
+        f"AI画像生成開始: job={job.id}, parent_id={job.parent_id}, "
+        f"prompt={job.prompt}, use_reference={job.use_reference}"
+    )
+
+    # 時間切れで失敗にされたジョブ（fail_stale_jobs）は、後から結果が届いても書き換えない
+    running = AIGenerationJob.objects.filter(pk=job.pk, status=AIGenerationJob.STATUS_RUNNING)
+
+    def save_partial(index, image_base64):
+        # 最新の部分画像だけを残す（SSE は partial_count が増えたら読み直す）
+        running.update(
+            partial_image=image_base64,
+            partial_count=index + 1,
+            progress=10 + 80 * (index + 1) // (settings.AI_PARTIAL_IMAGES + 1),
+        )
+
+    try:
+        reference = None
+        if job.reference_url:
+            logger.info(f"参照画像URL: {job.reference_url}")
+            reference = reference_image(job.parent_id, job.reference_url)
+        images = get_backend().generate(
+            build_prompt(job.prompt), reference, save_partial if job.stream else None,
+            count=job.candidates,
+        )
+        store = get_draft_store()
+        drafts = [AIDraft(job=job, image=store.save(image)) for image in images]
+    except Exception as e:
+        logger.error(f"AI画像生成エラー: job={job.id}: {e}", exc_info=True)
+        running.update(
+            status=AIGenerationJob.STATUS_FAILED,
+            error=user_error_message(e),
+            finished_at=timezone.now(),
+        )
+    else:
+        logger.info(f"AI画像生成成功: job={job.id}, candidates={len(drafts)}")
+        # 下書きを先に保存してから完了にする（完了を見たブラウザが必ず下書きを受け取れるように）
+        AIDraft.objects.bulk_create(drafts)
+        succeeded = running.update(
+            status=AIGenerationJob.STATUS_SUCCEEDED,
+            progress=100,
+            partial_image="",
+            finished_at=timezone.now(),
+        )
+        if not succeeded:
+            logger.warning(f"AI画像生成が時間切れの後に終わりました: job={job.id}")
+            _destroy_drafts(drafts)
+    finally:
+        if slot is not None:
+            admission.release_slot(slot)
+        # ワーカースレッドが開いたDB接続を閉じる
+        connections.close_all()
+
+
+def job_status(job):
+    """ステータスAPI・SSE で返すジョブの状態"""
+    data = {
+        'success': job.status != AIGenerationJob.STATUS_FAILED,
+        'status': job.status,
+        'progress': job.progress,
+    }
+    if job.status == AIGenerationJob.STATUS_QUEUED:
+        position = queue_position(job)
+        data['queue_position'] = position
+        data['estimated_wait'] = admission.estimated_wait(position, average_duration())
+    elif job.status == AIGenerationJob.STATUS_SUCCEEDED:
+        store = get_draft_store()
+        data['drafts'] = [
+            {'id': draft.id, **store.urls(draft.image)}
+            for draft in job.drafts.filter(page__isnull=True)
+        ]
+        data['message'] = 'AI画像生成が完了しました'
+    elif job.status == AIGenerationJob.STATUS_FAILED:
+        data['error'] = job.error
+    return data
+
+
+def _sse(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _poll_events(job_id, state):
+    """
+    ジョブを1回読んで、前回から変わった分のイベントを返す（job_events / ajob_events で共通）
+    state は {'status': 前回送った状態, 'frames': 送った部分画像の枚数, 'done': 終わったか}
+    """
+    jobs = AIGenerationJob.objects.filter(pk=job_id)
+    # 重い画像の列は、必要になったときだけ読む
+    job = jobs.defer('partial_image', 'prompt').first()
+    if job is None:
+        state['done'] = True
+        return []
+
+    if job.is_finished:
+        state['done'] = True
+        return [_sse('done', job_status(job))]
+
+    events = []
+    status = job_status(job)
+    if status != state['status']:
+        events.append(_sse('status', status))
+        state['status'] = status
+
+    if job.partial_count > state['frames']:
+        frame = jobs.values_list('partial_image', flat=True).first()
+        if frame:
+            state['frames'] = job.partial_count
+            events.append(_sse('frame', {
+                'index': state['frames'] - 1,
+                'image_data': f'data:image/png;base64,{frame}',
+            }, event_id=state['frames']))
+    return events
+
+
+def job_events(job_id, sent_frames=0):
+    """
+    ジョブの進み具合を Server-Sent Events で流すジェネレータ（WSGI 用。待っている間スレッドを使う）
+    - status: 待機順・進捗が変わったとき
+    - frame: 新しい部分画像が届いたとき（id は何枚目か。再接続時は Last-Event-ID の続きから送る）
+    - done: 完了・失敗したとき（ステータスAPIと同じ内容）
+    1本の接続は AI_STREAM_MAX_SECONDS で閉じ、ブラウザの EventSource に再接続させる
+    """
+    deadline = time.monotonic() + settings.AI_STREAM_MAX_SECONDS
+    state = {'status': None, 'frames': sent_frames, 'done': False}
+
+    yield "retry: 1000\n\n"
+    while True:
+        yield from _poll_events(job_id, state)
+        if state['done'] or time.monotonic() >= deadline:
+            return
+        time.sleep(settings.AI_STREAM_POLL_INTERVAL)
+
+
+async def ajob_events(job_id, sent_frames=0):
+    """
+    job_events の非同期ジェネレータ版（ASGI 用。待っている間スレッドを使わない）
+    WSGI では StreamingHttpResponse が非同期イテレータを最後まで読んでから送るので、job_events を使う
+    """
+    deadline = time.monotonic() + settings.AI_STREAM_MAX_SECONDS
+    state = {'status': None, 'frames': sent_frames, 'done': False}
+
+    yield "retry: 1000\n\n"
+    while True:
+        for event in await sync_to_async(_poll_events)(job_id, state):
+            yield event
+        if state['done'] or time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(settings.AI_STREAM_POLL_INTERVAL)
+
+
+def claim_draft(user, draft_id, parent):
+    """
+    ページ作成に使う下書きを返す（使えなければ None）
+    行をロックして確認するので、呼び出し側は transaction.atomic の中で呼び、
+    ページを保存したら use_draft で使用済みにする
+    """
+    return (
+        AIDraft.objects.select_for_update(of=('self',))
+        .filter(pk=draft_id, job__user=user, job__parent=parent, page__isnull=True)
+        .first()
+    )
+
+
+def draft_page_image(draft):
+    """下書きをページにするときに Page.image に入れる値"""
+    return get_draft_store().page_image(draft.image)
+
+
+def use_draft(draft, page):
+    AIDraft.objects.filter(pk=draft.pk).update(page=page)
+
+
+def _destroy_drafts(drafts):
+    """下書きの画像を消して下書きを削除し、消せた件数を返す"""
+    store = get_draft_store()
+    deleted = []
+    for draft in drafts:
+        try:
+            store.delete(draft.image)
+        except Exception:
+            logger.exception(f"AI下書きの削除に失敗しました: draft={draft.id}")
+            continue
+        deleted.append(draft.id)
+    AIDraft.objects.filter(pk__in=deleted).delete()
+    return len(deleted)
+
+
+def delete_expired_drafts(ttl):
+    """
+    使われなかった下書きの画像を消す
+    - ttl 秒を過ぎたもの
+    - ユーザーごとに新しい AI_MAX_DRAFTS_PER_USER 件より古いもの
+    """
+    unused = AIDraft.objects.filter(page__isnull=True).only('id', 'image')
+
+    limit = timezone.now() - timedelta(seconds=ttl)
+    deleted = _destroy_drafts(unused.filter(created_at__lt=limit))
+
+    overflow = unused.annotate(
+        newer=Window(
+            RowNumber(),
+            partition_by=[F('job__user_id')],
+            order_by=[F('created_at').desc(), F('id').desc()],
+        )
+    ).filter(newer__gt=settings.AI_MAX_DRAFTS_PER_USER)
+    return deleted + _destroy_drafts(overflow)
@@ -0,0 +1,131 @@
+"""
+AI画像生成のバックエンド
+
+settings.AI_BACKEND で使うクラスを選ぶ。どのバックエンドも
+generate(prompt, reference=None, on_partial=None, count=1) で count 枚の base64 の PNG のリストを返し、
+on_partial を渡されたら部分画像が届くたびに on_partial(番号, base64) を呼ぶ（count が 1 のときだけ）。
+DRAFT_STORE は生成画像（下書き）の置き場所（draft_stores）。
+
+- OpenAIBackend: 本番用（gpt-image-1.5）
+- FakeBackend: OpenAI を呼ばずに、プロンプトから決まる画像を返す負荷試験・開発用
+  （AI_FAKE_LATENCY 秒かけて生成し、AI_FAKE_FAILURE_RATE の割合で失敗する。下書きはローカルに置く）
+"""
+import base64
+import hashlib
+import io
+import random
+import threading
+import time
+
+from django.conf import settings
+from openai import OpenAI
+from PIL import Image
+
+
+class OpenAIBackend:
+    DRAFT_STORE = "manga.draft_stores.CloudinaryDraftStore"
+    MODEL = "gpt-image-1.5"
+    SIZE = "1024x1024"
+    QUALITY = "high"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+
+    def available(self):
+        return bool(settings.OPENAI_API_KEY)
+
+    def get_client(self):
+        """プロセスで共有する OpenAI クライアント（接続プールごと使い回す）"""
+        with self._lock:
+            if self._client is None:
+                self._client = OpenAI(api_key=settings.OPENAI_API_KEY)
+            return self._client
+
+    def generate(self, prompt, reference=None, on_partial=None, count=1):
+        client = self.get_client()
+        # 複数の候補は1回のリクエストでまとめて作る（ストリーミングは1枚のときだけ）
+        options = {'n': count}
+        if on_partial is not None and count == 1:
+            options = {'stream': True, 'partial_images': settings.AI_PARTIAL_IMAGES}
+
+        if reference is not None:
+            # 前のページ画像を参考にする（Edit API）
+            image_file = io.BytesIO(reference)
+            image_file.name = 'reference.png'
+
+            response = client.images.edit(
+                model=self.MODEL,
+                image=[image_file],
+                prompt=prompt,
+                size=self.SIZE,
+                quality=self.QUALITY,
+                input_fidelity="high",  # 高精度で参照
+                **options,
+            )
+        else:
+            # 通常の生成（Generation API）
+            response = client.images.generate(
+                model=self.MODEL,
+                prompt=prompt,
+                size=self.SIZE,
+                quality=self.QUALITY,
+                **options,
+            )
+
+        if not options.get('stream'):
+            return [image.b64_json for image in response.data]
+
+        for event in response:
+            if event.type.endswith('.partial_image'):
+                on_partial(event.partial_image_index, event.b64_json)
+            elif event.type.endswith('.completed'):
+                return [event.b64_json]
+        raise RuntimeError('生成された画像を受け取れませんでした')
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+class FakeBackend:
+    """
+    同じプロンプト・参照画像なら必ず同じ画像を返す偽のバックエンド
+    画像はプロンプトと候補の番号のハッシュで決まる色の縞模様で、部分画像は上から順に描き足していく
+    """
+    # 下書きもローカルに置き、ネットワークなしで試せるようにする
+    DRAFT_STORE = "manga.draft_stores.LocalDraftStore"
+    SIZE = 256
+    STRIPES = 8
+
+    def available(self):
+        return True
+
+    def generate(self, prompt, reference=None, on_partial=None, count=1):
+        digests = [
+            hashlib.sha256(f"{prompt}#{index}".encode() + (reference or b"")).digest()
+            for index in range(count)
+        ]
+        frames = settings.AI_PARTIAL_IMAGES if on_partial is not None and count == 1 else 0
+        step = settings.AI_FAKE_LATENCY / (frames + 1)
+
+        for index in range(frames):
+            time.sleep(step)
+            on_partial(index, self._render(digests[0], (index + 1) / (frames + 1)))
+        time.sleep(step)
+
+        if random.random() < settings.AI_FAKE_FAILURE_RATE:
+            raise FakeBackendError('rate_limit_exceeded (FakeBackend)')
+        return [self._render(digest, 1) for digest in digests]
+
+    def _render(self, digest, completed):
+        """digest の色で縞を描いた PNG（completed の割合まで上から塗る）"""
+        image = Image.new('RGB', (self.SIZE, self.SIZE), 'white')
+        stripe = self.SIZE // self.STRIPES
+        for index in range(round(self.STRIPES * completed)):
+            color = tuple(digest[index * 3:index * 3 + 3])
+            image.paste(color, (0, index * stripe, self.SIZE, (index + 1) * stripe))
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return base64.b64encode(buffer.getvalue()).decode()
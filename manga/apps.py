@@ -6,3 +6,4 @@ class MangaConfig(AppConfig):
 
     def ready(self):
         import manga.signals  # ← signals をロード
+        import manga.checks  # 設定チェックを登録
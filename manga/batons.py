@@ -0,0 +1,84 @@
+"""
+バトンパスと、未達成バトンの数（ヘッダーのバッジ用）
+
+pass_baton は複数の宛先にまとめてバトンを渡す。
+ユーザーの確認・バトンの作成・お知らせメールの積み込みを、宛先の数によらずそれぞれ1回のクエリで行う。
+
+未達成バトンの数は、すべてのページの表示で数えずに済むよう、ユーザーごとの数（重複を除いたページ数）を
+キャッシュに置く。バトンが作られた・完了した・消えたときに signals（bulk_create した場合は pass_baton）が
+コミット後に数え直して入れ替えるので、普段のページ表示では Baton テーブルを読まない
+（キャッシュが切れたときだけ数える）。
+REDIS_URL がない場合はプロセスごとのキャッシュになるので、
+ほかのプロセスの数は PENDING_BATON_CACHE_TIMEOUT 秒で切れて数え直す。
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+
+from . import outbox
+from .models import Baton
+
+PENDING_COUNT_KEY = "baton:pending-count:{user_id}"
+
+
+def refresh_pending_counts(user_ids):
+    """ユーザーごとの未達成バトンのページ数を1クエリで数え直してキャッシュに入れる"""
+    user_ids = set(user_ids)
+    counts = dict.fromkeys(user_ids, 0)
+    # (宛先, ページ) の組を重複なしで読んで数える（未達成バトンの部分インデックスだけで済む）
+    pairs = (
+        Baton.objects.filter(to_user_id__in=user_ids, is_completed=False)
+        .order_by()
+        .values_list('to_user', 'page')
+        .distinct()
+    )
+    for user_id, _ in pairs:
+        counts[user_id] += 1
+    cache.set_many(
+        {PENDING_COUNT_KEY.format(user_id=user_id): count for user_id, count in counts.items()},
+        timeout=settings.PENDING_BATON_CACHE_TIMEOUT,
+    )
+    return counts
+
+
+def pending_count(user_id):
+    """未達成バトンのページ数（キャッシュになければ数える）"""
+    count = cache.get(PENDING_COUNT_KEY.format(user_id=user_id))
+    if count is None:
+        count = refresh_pending_counts([user_id])[user_id]
+    return count
+
+
+def refresh_pending_counts_on_commit(user_ids):
+    """バトンを変えたトランザクションがコミットされたら数え直す"""
+    user_ids = set(user_ids)
+    transaction.on_commit(lambda: refresh_pending_counts(user_ids))
+
+
+def pass_baton(page, from_user, usernames, my_page_url):
+    """
+    usernames のユーザーにまとめてバトンを渡す
+    宛先ごとの結果 {'username', 'success', 'error'} のリストを入力の順で返す
+    """
+    users = {user.username: user for user in User.objects.filter(username__in=usernames)}
+
+    results, batons = [], []
+    for username in usernames:
+        to_user = users.get(username)
+        if to_user is None:
+            error = '指定されたユーザーが見つかりません'
+        elif to_user.pk == from_user.pk:
+            error = '自分自身にはバトンを渡せません'
+        else:
+            error = None
+            batons.append(Baton(page=page, from_user=from_user, to_user=to_user))
+        results.append({'username': username, 'success': error is None, 'error': error})
+
+    if batons:
+        # bulk_create では post_save が呼ばれないので、未達成バトン数はここで数え直す
+        with transaction.atomic():
+            batons = Baton.objects.bulk_create(batons)
+            outbox.enqueue_baton_notices(batons, my_page_url)
+            refresh_pending_counts_on_commit(baton.to_user_id for baton in batons)
+    return results
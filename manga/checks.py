@@ -0,0 +1,32 @@
+"""
+起動時の設定チェック（python manage.py check / migrate / run_ai_worker などで実行される）
+"""
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+# プロセスの中にしかないキャッシュ
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def ai_shared_cache_check(app_configs, **kwargs):
+    """
+    AI画像生成を使うなら、受付制御（admission）の回数制限と実行枠を置くキャッシュはプロセス間で共有されていること
+    プロセスごとのキャッシュだと、Webのプロセスごとに回数制限がかかり、ワーカーとも実行枠を共有できない
+    """
+    from .ai import get_backend
+
+    if settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES:
+        return []
+    if not get_backend().available():
+        return []
+
+    message = 'AI画像生成を使うには、プロセス間で共有するキャッシュ（REDIS_URL）が必要です'
+    hint = 'REDIS_URL を設定してください（回数制限と同時実行数の上限がプロセスごとになってしまいます）'
+    if settings.DEBUG:
+        # 開発サーバーでは Redis なしでも試せるよう、警告にとどめる
+        return [Warning(message, hint=hint, id='manga.W001')]
+    return [Error(message, hint=hint, id='manga.E001')]
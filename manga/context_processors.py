@@ -1,16 +1,12 @@
-from .models import Baton
+from . import batons
 
 def pending_baton_count(request):
     """
     未達成バトン数をすべてのテンプレートで利用可能にする
+    （数は batons がキャッシュしているので、普段は Baton テーブルを読まない）
     """
     if request.user.is_authenticated:
         # 未達成バトンのページ数（重複を除く）
-        count = Baton.objects.filter(
-            to_user=request.user,
-            is_completed=False
-        ).values('page').distinct().count()
-        
-        return {'pending_baton_count': count}
+        return {'pending_baton_count': batons.pending_count(request.user.id)}
     
-    return {'pending_baton_count': 0}
\ No newline at end of file
+    return {'pending_baton_count': 0}
@@ -0,0 +1,86 @@
+"""
+AI生成画像の下書き（AIDraft.image）の置き場所
+
+生成バックエンド（ai_backends）の DRAFT_STORE で決まり、settings.AI_DRAFT_STORE で上書きできる。
+どの置き場所も AIDraft.image に入れる値（public_id）を扱い、
+
+- save(image_base64): 画像を保存して AIDraft.image に入れる値を返す
+- urls(image): ブラウザに返すプレビュー・サムネイル・元画像の URL
+- page_image(image): ページにするときに Page.image に入れる値
+- delete(image): 画像を消す
+
+を持つ。
+
+- CloudinaryDraftStore: 本番用。Cloudinary にページと同じ変換をかけてアップロードする
+- LocalDraftStore: FakeBackend 用。MEDIA_ROOT に保存し、ネットワークを使わない
+  （ページにするときだけ Cloudinary にアップロードする）
+"""
+import base64
+import os
+import uuid
+
+import cloudinary.uploader
+from django.conf import settings
+
+from .models import Page
+
+DRAFT_FOLDER = "ai_drafts"
+
+
+def _page_upload_options(**options):
+    return {**Page._meta.get_field('image').options, **options}
+
+
+class CloudinaryDraftStore:
+    def save(self, image_base64):
+        return cloudinary.uploader.upload_resource(
+            f"data:image/png;base64,{image_base64}", **_page_upload_options(folder=DRAFT_FOLDER)
+        )
+
+    def urls(self, image):
+        return {
+            'preview_url': image.build_url(
+                width=512, height=512, crop='limit', quality='auto', fetch_format='auto'
+            ),
+            'thumbnail_url': image.build_url(
+                width=200, height=200, crop='fill', quality='auto', fetch_format='auto'
+            ),
+            'image_url': image.url,  # エディタで手直しするとき用
+        }
+
+    def page_image(self, image):
+        # 下書きにもページと同じ変換をかけてあるので、そのままページの画像にする
+        return image
+
+    def delete(self, image):
+        cloudinary.uploader.destroy(image.public_id)
+
+
+class LocalDraftStore:
+    """MEDIA_ROOT/ai_drafts/ に PNG を置く（開発サーバーの /media/ で表示できる）"""
+
+    def _path(self, public_id):
+        return os.path.join(settings.MEDIA_ROOT, f"{public_id}.png")
+
+    def save(self, image_base64):
+        # 拡張子は CloudinaryField が形式として切り離すので、public_id には付けない
+        public_id = f"{DRAFT_FOLDER}/{uuid.uuid4().hex}"
+        path = self._path(public_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(base64.b64decode(image_base64))
+        return public_id
+
+    def urls(self, image):
+        url = f"{settings.MEDIA_URL}{image.public_id}.png"
+        return {'preview_url': url, 'thumbnail_url': url, 'image_url': url}
+
+    def page_image(self, image):
+        with open(self._path(image.public_id), 'rb') as f:
+            return cloudinary.uploader.upload_resource(f, **_page_upload_options())
+
+    def delete(self, image):
+        try:
+            os.remove(self._path(image.public_id))
+        except FileNotFoundError:
+            pass
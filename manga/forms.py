@@ -1,4 +1,7 @@
+import re
+
 from django import forms
+from django.conf import settings
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from .models import Manga, Page, UserProfile, Baton
@@ -79,22 +82,26 @@ class UserProfileForm(forms.ModelForm):
 
 
 class BatonPassForm(forms.Form):
-    """バトンパスフォーム"""
+    """バトンパスフォーム（カンマ・空白・改行区切りで複数のユーザーに渡せる）"""
     to_user = forms.CharField(
         label='送り先のユーザー名',
         widget=forms.TextInput(attrs={
             'class': 'w-full border rounded px-3 py-2 focus:outline-none focus:ring focus:ring-blue-300',
-            'placeholder': 'ユーザー名を入力'
+            'placeholder': 'ユーザー名を入力（複数のときはカンマ区切り）'
         })
     )
     
     def clean_to_user(self):
-        username = self.cleaned_data['to_user']
-        try:
-            user = User.objects.get(username=username)
-            return user
-        except User.DoesNotExist:
-            raise forms.ValidationError('指定されたユーザーが見つかりません')
+        """ユーザー名のリスト（重複を除き、入力の順）を返す。ユーザーの確認は渡すときにまとめて行う"""
+        names = re.split(r'[\s,、，]+', self.cleaned_data['to_user'])
+        usernames = list(dict.fromkeys(name for name in names if name))
+        if not usernames:
+            raise forms.ValidationError('ユーザー名を入力してください')
+        if len(usernames) > settings.BATON_MAX_RECIPIENTS:
+            raise forms.ValidationError(
+                f'一度に渡せるのは{settings.BATON_MAX_RECIPIENTS}人までです'
+            )
+        return usernames
 
 
 class UsernameChangeForm(forms.Form):
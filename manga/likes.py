@@ -0,0 +1,261 @@
+"""
+うぃーねの書き込みをまとめて行う（write-behind）
+
+クリックごとに Page を UPDATE する代わりに、
+- 表示用の未反映数は共有キャッシュのカウンタ（cache.incr）に積み、
+- 実際に DB へ書く分はプロセス内のバッファに積んで、
+LIKE_FLUSH_INTERVAL 秒ごとにページ単位でまとめて likes と優先度へ反映する。
+バズったページでも DB への書き込みは数秒に1回で済む。
+
+同じ閲覧者（ログインユーザーまたはセッション）が同じページに押せるのは1回だけで、
+記録（PageLike）もフラッシュ時にまとめて INSERT し、実際に入った記録の数だけ likes を増やす。
+
+プロセスが落ちると、そのプロセスのバッファ（最大 LIKE_FLUSH_INTERVAL 秒分）は失われる。
+"""
+import atexit
+import logging
+import threading
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Page, PageLike
+from .tree import apply_cached_likes, bump_tree_version
+
+logger = logging.getLogger(__name__)
+
+# 記録を1回の INSERT で入れる件数（SQLite のパラメータ数の上限に収まるように）
+INSERT_BATCH_SIZE = 200
+
+_lock = threading.Lock()
+_buffer = {}  # page_id -> このプロセスでまだ DB に書いていない閲覧者の集合
+_timer = None
+
+# うぃーねした人。ログインしていればユーザーID、していなければセッションキーで区別する
+Viewer = namedtuple('Viewer', ['user_id', 'session_key'])
+
+
+def get_viewer(request, create_session=False):
+    """リクエストの閲覧者を返す。匿名でセッションがなければ None（create_session=True なら作る）"""
+    if request.user.is_authenticated:
+        return Viewer(request.user.id, "")
+    if not request.session.session_key:
+        if not create_session:
+            return None
+        request.session.save()
+    return Viewer(None, request.session.session_key)
+
+
+def _viewer_token(viewer):
+    return f"u{viewer.user_id}" if viewer.user_id else f"s{viewer.session_key}"
+
+
+def _viewer_filter(viewer):
+    if viewer.user_id:
+        return Q(user_id=viewer.user_id)
+    return Q(user__isnull=True, session_key=viewer.session_key)
+
+
+def pending_key(page_id):
+    return f"likes:pending:{page_id}"
+
+
+def liked_key(viewer, page_id):
+    return f"likes:liked:{_viewer_token(viewer)}:{page_id}"
+
+
+def path_state(viewer, page_ids):
+    """
+    ビューアの経路上のページについて、
+    まだ DB に反映されていないうぃーね数（全プロセス分）と、閲覧者がうぃーね済みのページを返す
+    キャッシュ1往復 + うぃーね記録1クエリで済む
+    """
+    keys = {pending_key(page_id): page_id for page_id in page_ids}
+    liked_keys = {}
+    if viewer is not None:
+        liked_keys = {liked_key(viewer, page_id): page_id for page_id in page_ids}
+
+    found = cache.get_many([*keys, *liked_keys])
+    pending = {keys[key]: max(value, 0) for key, value in found.items() if key in keys}
+    liked = {liked_keys[key] for key in found if key in liked_keys}
+
+    if viewer is not None:
+        liked.update(
+            PageLike.objects.filter(_viewer_filter(viewer), page_id__in=page_ids)
+            .values_list('page_id', flat=True)
+        )
+    return pending, liked
+
+
+def add_like(page, viewer):
+    """
+    うぃーねをバッファに積み、(未反映分を含めた現在のうぃーね数, 今回数えたか) を返す
+    同じ閲覧者の2回目以降は数えない
+    """
+    key = pending_key(page.id)
+
+    # 二重押しの判定（キャッシュで弾けなければ記録を1件だけ確認する）
+    first_time = cache.add(liked_key(viewer, page.id), 1, timeout=settings.LIKE_DEDUP_TIMEOUT)
+    if first_time:
+        first_time = not PageLike.objects.filter(_viewer_filter(viewer), page=page).exists()
+    if not first_time:
+        pending = cache.get(key) or 0
+        return page.likes + max(pending, 0), False
+
+    with _lock:
+        # 判定用のキーが追い出されても、このプロセスのバッファにあればまだ反映前の2回目
+        viewers = _buffer.setdefault(page.id, set())
+        counted = viewer not in viewers
+        viewers.add(viewer)
+    if not counted:
+        pending = cache.get(key) or 0
+        return page.likes + max(pending, 0), False
+
+    cache.add(key, 0, timeout=None)
+    try:
+        pending = cache.incr(key)
+    except ValueError:
+        # add と incr の間にキーが追い出された場合
+        cache.set(key, 1, timeout=None)
+        pending = 1
+
+    _schedule_flush()
+    return page.likes + max(pending, 0), True
+
+
+def _schedule_flush():
+    global _timer
+    if settings.LIKE_FLUSH_INTERVAL <= 0:
+        flush()
+        return
+    with _lock:
+        if _timer is not None:
+            return
+        _timer = threading.Timer(settings.LIKE_FLUSH_INTERVAL, _flush_on_timer)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _flush_on_timer():
+    global _timer
+    with _lock:
+        _timer = None
+    try:
+        flush()
+    except Exception:
+        logger.exception("うぃーねの反映に失敗しました。次の間隔で再試行します")
+        _schedule_flush()
+    finally:
+        # タイマースレッドが開いたDB接続を閉じる
+        connections.close_all()
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception("終了時のうぃーねの反映に失敗しました")
+
+
+def _existing_likes(batch):
+    """バッファ中の (ページ, 閲覧者) のうち、すでに記録があるものを1クエリで取得"""
+    user_ids = set()
+    session_keys = set()
+    for viewers in batch.values():
+        for viewer in viewers:
+            if viewer.user_id:
+                user_ids.add(viewer.user_id)
+            else:
+                session_keys.add(viewer.session_key)
+
+    rows = PageLike.objects.filter(
+        Q(user_id__in=user_ids) | Q(user__isnull=True, session_key__in=session_keys),
+        page_id__in=batch,
+    ).values_list('page_id', 'user_id', 'session_key')
+    return {
+        (page_id, Viewer(user_id, "") if user_id else Viewer(None, session_key))
+        for page_id, user_id, session_key in rows
+    }
+
+
+def _insert_likes(records):
+    """
+    (ページID, 閲覧者) の記録を INSERT ... ON CONFLICT DO NOTHING RETURNING でまとめて入れ、
+    実際に入ったページごとの件数を返す（同じ閲覧者の記録を別のプロセスが先に入れていたら数えない）
+    """
+    counts = Counter()
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    table = PageLike._meta.db_table
+    for start in range(0, len(records), INSERT_BATCH_SIZE):
+        chunk = records[start:start + INSERT_BATCH_SIZE]
+        params = []
+        for page_id, viewer in chunk:
+            params.extend([page_id, viewer.user_id, viewer.session_key, now])
+        values = ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (page_id, user_id, session_key, created_at) VALUES {values} "
+                f"ON CONFLICT DO NOTHING RETURNING page_id",
+                params,
+            )
+            counts.update(page_id for page_id, in cursor.fetchall())
+    return counts
+
+
+def flush():
+    """
+    バッファのうぃーねをまとめて記録し、新しく記録できた数だけ
+    Page.likes と祖先の優先度に反映する
+    """
+    with _lock:
+        batch = dict(_buffer)
+        _buffer.clear()
+    if not batch:
+        return
+
+    try:
+        pages = Page.objects.only('id', 'manga_id', 'path', 'likes', 'subtree_priority').in_bulk(batch)
+        with transaction.atomic():
+            existing = _existing_likes(batch)
+            records = [
+                (page_id, viewer)
+                for page_id, viewers in batch.items()
+                if page_id in pages  # 反映前に削除されたページは捨てる
+                for viewer in viewers
+                if (page_id, viewer) not in existing
+            ]
+            # 別のプロセスが同じ閲覧者の記録を同時に入れることがあるので、実際に入った数だけ数える
+            counts = _insert_likes(records)
+
+            by_manga = {}
+            for page_id, count in counts.items():
+                pages[page_id].add_likes(count)
+                by_manga.setdefault(pages[page_id].manga_id, {})[page_id] = count
+            # ページの構成は変わらないので、ツリービュー用の JSON はそのまま使い、
+            # このプロセスのツリーには反映した数を足して引き継ぐ
+            for manga_id, manga_counts in by_manga.items():
+                version = bump_tree_version(manga_id, structure=False)
+                if version is not None:
+                    transaction.on_commit(
+                        lambda manga_id=manga_id, version=version, manga_counts=manga_counts:
+                        apply_cached_likes(manga_id, version, manga_counts)
+                    )
+    except Exception:
+        # 書けなかった分は次回に回す
+        with _lock:
+            for page_id, viewers in batch.items():
+                _buffer.setdefault(page_id, set()).update(viewers)
+        raise
+
+    for page_id, viewers in batch.items():
+        try:
+            cache.decr(pending_key(page_id), len(viewers))
+        except ValueError:
+            pass
+
+
+atexit.register(_flush_at_exit)
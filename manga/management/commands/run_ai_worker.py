@@ -0,0 +1,68 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from manga import admission, ai
+
+logger = logging.getLogger(__name__)
+
+# 使われなかった下書きの掃除をする間隔（秒）
+DRAFT_CLEANUP_INTERVAL = 60 * 60
+
+
+class Command(BaseCommand):
+    help = "AI画像生成ジョブを処理するワーカーを起動する（DBをキューとして使う）"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.AI_WORKER_CONCURRENCY,
+            help="同時に生成するジョブ数",
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help="待機中のジョブを処理し終えたら終了する",
+        )
+
+    def handle(self, *args, concurrency, once, **options):
+        concurrency = max(concurrency, 1)
+        self.stdout.write(f"AIワーカーを起動しました（同時実行数: {concurrency}）")
+
+        running = set()
+        next_cleanup = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                for future in [future for future in running if future.done()]:
+                    running.discard(future)
+                    if future.exception() is not None:
+                        logger.error("AIジョブの処理中にエラーが発生しました", exc_info=future.exception())
+                ai.fail_stale_jobs(settings.AI_JOB_TIMEOUT)
+                if time.monotonic() >= next_cleanup:
+                    ai.delete_expired_drafts(settings.AI_DRAFT_TTL)
+                    next_cleanup = time.monotonic() + DRAFT_CLEANUP_INTERVAL
+
+                # 空いている枠の分だけジョブを取る（全ワーカー共通の枠と上流APIの頻度制限の範囲で）
+                claimed = False
+                while len(running) < concurrency:
+                    slot = admission.acquire_slot()
+                    if slot is None:
+                        break
+                    if not admission.take_global_token():
+                        admission.release_slot(slot)
+                        break
+                    job = ai.claim_next_job()
+                    if job is None:
+                        admission.give_back_global_token()
+                        admission.release_slot(slot)
+                        break
+                    claimed = True
+                    running.add(executor.submit(ai.run_job, job, slot))
+
+                if once and not claimed and not running:
+                    break
+                # 待っている間はDB接続を持ち続けない
+                connections.close_all()
+                time.sleep(settings.AI_WORKER_POLL_INTERVAL)
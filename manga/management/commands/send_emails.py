@@ -0,0 +1,38 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from manga import outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "送信待ちのメール（OutgoingEmail）をまとめて送る"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help="送る時刻になったメールを送り終えたら終了する（cron から呼ぶ場合）",
+        )
+
+    def handle(self, *args, once, **options):
+        self.stdout.write("メール送信を開始しました")
+        while True:
+            try:
+                sent, failed = outbox.send_pending()
+            except Exception:
+                logger.exception("メールの送信中にエラーが発生しました")
+                sent, failed = 0, 0
+            if sent or failed:
+                logger.info(f"メール送信: 成功 {sent} 通, 失敗 {failed} 通")
+                # 1回で取り切れなかった分があるかもしれないので、待たずに続ける
+                continue
+            if once:
+                break
+            # 待っている間はDB接続を持ち続けない
+            connections.close_all()
+            time.sleep(settings.EMAIL_SEND_INTERVAL)
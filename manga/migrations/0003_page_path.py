@@ -0,0 +1,56 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:54
+
+from django.db import migrations, models
+
+
+def backfill_page_path(apps, schema_editor):
+    """既存ページの path / depth を親子関係から埋める"""
+    Page = apps.get_model("manga", "Page")
+    parents = dict(Page.objects.values_list("id", "parent_id"))
+
+    paths = {}
+
+    def resolve(page_id):
+        # 深いチェーンでも再帰しないよう、未解決の祖先をスタックに積む
+        chain = []
+        current = page_id
+        while current is not None and current not in paths:
+            chain.append(current)
+            current = parents[current]
+        prefix = paths[current] if current is not None else None
+        for pk in reversed(chain):
+            parent_id = parents[pk]
+            if parent_id is None:
+                paths[pk] = ""
+            else:
+                paths[pk] = f"{prefix}{parent_id}/"
+            prefix = paths[pk]
+        return paths[page_id]
+
+    pages = []
+    for page in Page.objects.only("id", "path", "depth").iterator():
+        page.path = resolve(page.id)
+        page.depth = page.path.count("/")
+        pages.append(page)
+    Page.objects.bulk_update(pages, ["path", "depth"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0002_baton_userprofile"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="page",
+            name="depth",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="page",
+            name="path",
+            field=models.TextField(blank=True, db_index=True, default=""),
+        ),
+        migrations.RunPython(backfill_page_path, migrations.RunPython.noop),
+    ]
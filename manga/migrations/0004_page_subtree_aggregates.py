@@ -0,0 +1,48 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+def backfill_subtree_aggregates(apps, schema_editor):
+    """深いページから順に、子の集計値を親へ積み上げる"""
+    Page = apps.get_model("manga", "Page")
+    pages = list(
+        Page.objects.only("id", "parent_id", "likes", "depth").order_by("-depth")
+    )
+    priority = {page.id: page.likes for page in pages}
+    descendants = {page.id: 0 for page in pages}
+
+    for page in pages:
+        if page.parent_id is not None:
+            priority[page.parent_id] += 1 + priority[page.id]
+            descendants[page.parent_id] += 1 + descendants[page.id]
+
+    for page in pages:
+        page.subtree_priority = priority[page.id]
+        page.descendant_count = descendants[page.id]
+    Page.objects.bulk_update(
+        pages, ["subtree_priority", "descendant_count"], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0003_page_path"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="page",
+            name="descendant_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="page",
+            name="subtree_priority",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(
+            backfill_subtree_aggregates, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0004_page_subtree_aggregates"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="manga",
+            name="tree_version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
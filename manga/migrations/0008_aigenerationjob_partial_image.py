@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0007_aigenerationjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aigenerationjob",
+            name="partial_count",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="aigenerationjob",
+            name="partial_image",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="aigenerationjob",
+            name="stream",
+            field=models.BooleanField(default=False),
+        ),
+    ]
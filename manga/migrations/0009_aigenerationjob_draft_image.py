@@ -0,0 +1,37 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:09
+
+import cloudinary.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0008_aigenerationjob_partial_image"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="aigenerationjob",
+            name="result_image",
+        ),
+        migrations.AddField(
+            model_name="aigenerationjob",
+            name="image",
+            field=cloudinary.models.CloudinaryField(
+                blank=True, max_length=255, null=True, verbose_name="image"
+            ),
+        ),
+        migrations.AddField(
+            model_name="aigenerationjob",
+            name="page",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="manga.page",
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0009_aigenerationjob_draft_image"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aigenerationjob",
+            name="dedup_key",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name="aigenerationjob",
+            index=models.Index(
+                fields=["user", "dedup_key"], name="ai_job_user_dedup_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:14
+
+import cloudinary.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_images_to_drafts(apps, schema_editor):
+    """ジョブに直接持っていた生成画像を下書きに移す"""
+    AIGenerationJob = apps.get_model("manga", "AIGenerationJob")
+    AIDraft = apps.get_model("manga", "AIDraft")
+    jobs = AIGenerationJob.objects.filter(image__isnull=False).exclude(image="")
+    AIDraft.objects.bulk_create(
+        [
+            AIDraft(job_id=job.id, image=job.image, page_id=job.page_id)
+            for job in jobs.only("id", "image", "page_id")
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0010_aigenerationjob_dedup_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aigenerationjob",
+            name="candidates",
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name="AIDraft",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "image",
+                    cloudinary.models.CloudinaryField(
+                        max_length=255, verbose_name="image"
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="drafts",
+                        to="manga.aigenerationjob",
+                    ),
+                ),
+                (
+                    "page",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="manga.page",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["id"],
+            },
+        ),
+        migrations.RunPython(move_images_to_drafts, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="aigenerationjob",
+            name="image",
+        ),
+        migrations.RemoveField(
+            model_name="aigenerationjob",
+            name="page",
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0012_outgoingemail"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="baton",
+            index=models.Index(
+                condition=models.Q(("is_completed", False)),
+                fields=["to_user", "page", "created_at"],
+                name="baton_pending_inbox_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="baton",
+            index=models.Index(
+                condition=models.Q(("is_completed", True)),
+                fields=["to_user", "page", "created_at"],
+                name="baton_completed_inbox_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="page",
+            index=models.Index(
+                condition=models.Q(("parent__isnull", True)),
+                fields=["manga"],
+                name="page_manga_root_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="page",
+            index=models.Index(
+                fields=["author", "-created_at", "-id"], name="page_author_created_idx"
+            ),
+        ),
+    ]
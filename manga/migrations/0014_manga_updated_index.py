@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0013_hot_query_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="manga",
+            index=models.Index(fields=["-updated_at", "-id"], name="manga_updated_idx"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("manga", "0014_manga_updated_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="manga",
+            name="structure_version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
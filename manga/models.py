@@ -1,5 +1,7 @@
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
+from django.utils import timezone
 from cloudinary.models import CloudinaryField
 
 class Manga(models.Model):
@@ -23,6 +25,17 @@ class Manga(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # ページツリーが変わるたびに増える（ツリーキャッシュのキーに使う）
+    tree_version = models.PositiveIntegerField(default=0)
+    # ページの追加・削除でだけ増える（うぃーね数を含まないツリービュー用 JSON のキャッシュキーに使う）
+    structure_version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # マンガ一覧（更新日時の新しい順のキーセットページング）
+            models.Index(fields=['-updated_at', '-id'], name='manga_updated_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
@@ -52,6 +65,29 @@ class Page(models.Model):
     
     likes = models.PositiveIntegerField(default=0)
 
+    # 祖先ページのIDをルートから順に並べたパス（例: "1/5/23/"）。ルートは空文字
+    path = models.TextField(blank=True, default="", db_index=True)
+    depth = models.PositiveIntegerField(default=0)
+
+    # 子孫を含めた集計値（ページ追加・削除・うぃーね時に祖先へ差分で反映）
+    subtree_priority = models.PositiveIntegerField(default=0)
+    descendant_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # 1ページ目（ルート）があるかの確認（create_page）
+            models.Index(
+                fields=['manga'],
+                condition=models.Q(parent__isnull=True),
+                name='page_manga_root_idx',
+            ),
+            # マイページの「描いたページ」（新しい順のキーセットページネーション）
+            models.Index(
+                fields=['author', '-created_at', '-id'],
+                name='page_author_created_idx',
+            ),
+        ]
+
     @property
     def display_title(self):
         """空なら 'Page {id}' を返す"""
@@ -69,19 +105,77 @@ class Page(models.Model):
     def __str__(self):
         return f"{self.manga.title} - {self.display_title} by {self.author.username}"
 
+    @property
+    def ancestor_ids(self):
+        """祖先ページのID（ルート→親の順）"""
+        return [int(pk) for pk in self.path.split('/') if pk]
+
+    @property
+    def subtree_path(self):
+        """子孫ページの path が必ず先頭に持つ文字列"""
+        return f"{self.path}{self.pk}/"
+
+    def get_ancestors(self):
+        """祖先ページをルートから順に1クエリで取得"""
+        return Page.objects.filter(id__in=self.ancestor_ids).order_by('depth')
+
+    def get_descendants(self):
+        """子孫ページをすべて1クエリで取得"""
+        return Page.objects.filter(path__startswith=self.subtree_path)
+
     def count_descendants(self):
-        """再帰的にすべての子孫ページ数を数える"""
-        total = self.children.count()
-        for child in self.children.all():
-            total += child.count_descendants()
-        return total
+        """すべての子孫ページ数（集計済みの値）"""
+        return self.descendant_count
 
     def get_priority(self):
         """ページの優先度（likes + 子孫の優先度）"""
-        total = self.likes
-        for child in self.children.all():
-            total += 1 + child.get_priority()
-        return total
+        return self.subtree_priority
+
+    def update_ancestor_aggregates(self, descendants=0, priority=0):
+        """祖先ページの子孫数・優先度に差分を反映する（1クエリ）"""
+        ancestor_ids = self.ancestor_ids
+        if ancestor_ids:
+            Page.objects.filter(id__in=ancestor_ids).update(
+                descendant_count=F('descendant_count') + descendants,
+                subtree_priority=F('subtree_priority') + priority,
+            )
+
+    def add_likes(self, count=1):
+        """うぃーねを加算し、自分と祖先の優先度にも反映する"""
+        Page.objects.filter(pk=self.pk).update(
+            likes=F('likes') + count,
+            subtree_priority=F('subtree_priority') + count,
+        )
+        self.update_ancestor_aggregates(priority=count)
+        self.likes += count
+        self.subtree_priority += count
+
+
+class PageLike(models.Model):
+    """うぃーねの記録（ログインユーザーまたはセッションごとに1ページ1回まで）"""
+    page = models.ForeignKey(Page, on_delete=models.CASCADE, related_name='like_records')
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE, related_name='page_likes')
+    session_key = models.CharField(max_length=40, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # 閲覧者を先頭にして「この人がどのページにうぃーね済みか」の検索にも使う
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'page'],
+                condition=models.Q(user__isnull=False),
+                name='unique_page_like_per_user',
+            ),
+            models.UniqueConstraint(
+                fields=['session_key', 'page'],
+                condition=models.Q(user__isnull=True),
+                name='unique_page_like_per_session',
+            ),
+        ]
+
+    def __str__(self):
+        who = self.user.username if self.user_id else f"session {self.session_key[:8]}"
+        return f"{who} likes {self.page.display_title}"
 
 
 class UserProfile(models.Model):
@@ -103,6 +197,134 @@ class Baton(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        # 受け取ったバトンは未達成・達成済みに分けて引くので、それぞれの部分インデックスにする
+        # （ヘッダーの件数、マイページのページごとのまとめ、ページ追加時の完了処理）
+        indexes = [
+            models.Index(
+                fields=['to_user', 'page', 'created_at'],
+                condition=models.Q(is_completed=False),
+                name='baton_pending_inbox_idx',
+            ),
+            models.Index(
+                fields=['to_user', 'page', 'created_at'],
+                condition=models.Q(is_completed=True),
+                name='baton_completed_inbox_idx',
+            ),
+        ]
     
     def __str__(self):
-        return f"Baton from {self.from_user.username} to {self.to_user.username} for {self.page.display_title}"
\ No newline at end of file
+        return f"Baton from {self.from_user.username} to {self.to_user.username} for {self.page.display_title}"
+
+class AIGenerationJob(models.Model):
+    """
+    AI画像生成のジョブ（ワーカープロセスが queued のものを順に処理する）
+    完了すると、候補の数だけ生成画像の下書き（AIDraft）ができる
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, '待機中'),
+        (STATUS_RUNNING, '生成中'),
+        (STATUS_SUCCEEDED, '完了'),
+        (STATUS_FAILED, '失敗'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ai_jobs')
+    parent = models.ForeignKey(Page, on_delete=models.CASCADE, related_name='ai_jobs')
+    prompt = models.TextField()
+    use_reference = models.BooleanField(default=False)
+    # 参照画像の絶対URL（リクエストのないワーカーでも取得できるよう受付時に決めておく）
+    reference_url = models.URLField(max_length=500, blank=True, default="")
+    # 部分画像をストリーミングで受け取るか（SSE で表示する場合）
+    stream = models.BooleanField(default=False)
+    # 1回の生成で作る候補の数
+    candidates = models.PositiveSmallIntegerField(default=1)
+    # 同じ内容のリクエストを見分けるキー（親ページ・プロンプト・参照画像・生成条件のハッシュ）
+    dedup_key = models.CharField(max_length=64, blank=True, default="")
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    progress = models.PositiveSmallIntegerField(default=0)  # 0〜100
+    partial_image = models.TextField(blank=True, default="")  # 最新の部分画像（base64 PNG）
+    partial_count = models.PositiveSmallIntegerField(default=0)  # 届いた部分画像の枚数
+    error = models.TextField(blank=True, default="")  # 利用者に見せるエラーメッセージ
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='ai_job_status_created_idx'),
+            models.Index(fields=['user', 'dedup_key'], name='ai_job_user_dedup_idx'),
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_SUCCEEDED, self.STATUS_FAILED)
+
+    def __str__(self):
+        return f"AI job {self.id} ({self.status}) for {self.parent.display_title}"
+
+
+class AIDraft(models.Model):
+    """AI生成画像の下書き。ブラウザを経由せずにそのままページの画像にできる"""
+    job = models.ForeignKey(AIGenerationJob, on_delete=models.CASCADE, related_name='drafts')
+    image = CloudinaryField('image')
+    # 下書きから作られたページ（同じ下書きを2回使わないため）
+    page = models.ForeignKey(
+        Page, null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"AI draft {self.id} of job {self.job_id}"
+
+
+class OutgoingEmail(models.Model):
+    """
+    送信待ちのメール（アウトボックス）
+    バトンと同じトランザクションで作り、send_emails コマンドがまとめて送る
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, '送信待ち'),
+        (STATUS_SENDING, '送信中'),
+        (STATUS_SENT, '送信済み'),
+        (STATUS_FAILED, '送信失敗'),
+    ]
+
+    to_email = models.EmailField()
+    subject = models.CharField(max_length=200)
+    body = models.TextField()
+    # 同じ宛先のメールを1通にまとめるときに並べる1行と、最後に付けるURL
+    summary = models.CharField(max_length=300, blank=True, default="")
+    url = models.URLField(max_length=500, blank=True, default="")
+    baton = models.ForeignKey(
+        Baton, null=True, blank=True, on_delete=models.SET_NULL, related_name='emails'
+    )
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # この時刻を過ぎたら送る（送信中はこの時刻を過ぎても終わらなければ送り直す）
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outgoing_email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"Email to {self.to_email} ({self.status})"
@@ -0,0 +1,166 @@
+"""
+メールの送信（トランザクショナル・アウトボックス）
+
+リクエストの中では SMTP に接続しない。
+バトンを作るのと同じトランザクションで OutgoingEmail を保存しておき、
+送信プロセス（python manage.py send_emails）が送信待ちのものをまとめて取り出して、
+1本の SMTP 接続（get_connection）で続けて送る。
+
+- 同じ宛先に何通も溜まっていたら、1通のまとめメールにして送る
+  （届いてから EMAIL_DIGEST_WINDOW 秒は待って、続けて届くバトンとまとめる）
+- 送れなかったものは EMAIL_RETRY_DELAY 秒から倍々に間隔をあけて再送し、
+  EMAIL_MAX_ATTEMPTS 回失敗したら諦める
+- 取り出したメールは送信中にして、EMAIL_SEND_TIMEOUT 秒たっても終わらなければ送り直す
+  （送信プロセスが複数いても二重に送らず、途中で落ちてもメールはなくならない）
+"""
+import logging
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import OutgoingEmail, UserProfile
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_baton_notices(batons, my_page_url):
+    """
+    バトンを受け取ったユーザーへのお知らせをまとめて送信待ちにする（メールアドレスがない人には送らない）
+    バトンと一緒に transaction.atomic の中で呼ぶ。送信待ちにした OutgoingEmail のリストを返す
+    """
+    emails = dict(
+        UserProfile.objects.filter(user_id__in={baton.to_user_id for baton in batons})
+        .exclude(email__isnull=True).exclude(email='')
+        .values_list('user_id', 'email')
+    )
+    send_at = timezone.now() + timedelta(seconds=settings.EMAIL_DIGEST_WINDOW)
+    return OutgoingEmail.objects.bulk_create([
+        _baton_notice(baton, emails[baton.to_user_id], my_page_url, send_at)
+        for baton in batons
+        if baton.to_user_id in emails
+    ])
+
+
+def _baton_notice(baton, email, my_page_url, send_at):
+    from_name = baton.from_user.username
+    page = baton.page
+    return OutgoingEmail(
+        to_email=email,
+        subject=f'【リレーマンガ】{from_name}さんからバトンが届きました',
+        body=f'{from_name}さんから「{page.manga.title}」のバトンが届きました。\n\n'
+             f'ページ: {page.display_title}\n\n'
+             f'マイページから確認してください：\n'
+             f'{my_page_url}\n\n'
+             f'続きを描いてみませんか？',
+        summary=f'{from_name}さんから「{page.manga.title}」の{page.display_title}',
+        url=my_page_url,
+        baton=baton,
+        next_attempt_at=send_at,
+    )
+
+
+def _claim(batch_size):
+    """
+    送る時刻になったメールを batch_size 件まで取り出す
+    同じ宛先でまだ待っているメール（まとめ待ち）も一緒に取り出す
+    """
+    now = timezone.now()
+    # 送る時刻になったもの（送信中のまま時間切れになったものを含む）
+    due = Q(
+        status__in=[OutgoingEmail.STATUS_PENDING, OutgoingEmail.STATUS_SENDING],
+        next_attempt_at__lte=now,
+    )
+    # まだ一度も送っていない、まとめ待ちのもの
+    waiting = Q(status=OutgoingEmail.STATUS_PENDING, attempts=0)
+    emails = OutgoingEmail.objects.select_for_update(skip_locked=True)
+    with transaction.atomic():
+        recipients = set(emails.filter(due).values_list('to_email', flat=True)[:batch_size])
+        if not recipients:
+            return []
+        claimed = list(
+            emails.filter(due | waiting, to_email__in=recipients).order_by('to_email', 'id')
+        )
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in claimed]).update(
+            status=OutgoingEmail.STATUS_SENDING,
+            next_attempt_at=now + timedelta(seconds=settings.EMAIL_SEND_TIMEOUT),
+        )
+    return claimed
+
+
+def _build_message(emails, connection):
+    """同じ宛先のメールを1通にする（1通だけならそのまま）"""
+    if len(emails) == 1:
+        email = emails[0]
+        return EmailMessage(email.subject, email.body, to=[email.to_email], connection=connection)
+
+    lines = '\n'.join(f'・{email.summary}' for email in emails)
+    return EmailMessage(
+        f'【リレーマンガ】バトンが{len(emails)}件届きました',
+        f'バトンが{len(emails)}件届きました。\n\n'
+        f'{lines}\n\n'
+        f'マイページから確認してください：\n'
+        f'{emails[-1].url}\n\n'
+        f'続きを描いてみませんか？',
+        to=[emails[0].to_email],
+        connection=connection,
+    )
+
+
+def _retry_later(emails, error):
+    """送れなかったメールを、回数に応じて間をあけて送り直す（上限を超えたら失敗にする）"""
+    now = timezone.now()
+    for email in emails:
+        email.attempts += 1
+        email.last_error = str(error)[:1000]
+        if email.attempts >= settings.EMAIL_MAX_ATTEMPTS:
+            email.status = OutgoingEmail.STATUS_FAILED
+        else:
+            email.status = OutgoingEmail.STATUS_PENDING
+            delay = settings.EMAIL_RETRY_DELAY * 2 ** (email.attempts - 1)
+            email.next_attempt_at = now + timedelta(seconds=delay)
+    OutgoingEmail.objects.bulk_update(
+        emails, ['attempts', 'last_error', 'status', 'next_attempt_at']
+    )
+
+
+def send_pending(batch_size=None):
+    """
+    送信待ちのメールを1回分送り、(送った数, 失敗した数) を返す
+    接続は1本だけ開いて、まとめたメールを続けて送る
+    """
+    emails = _claim(batch_size or settings.EMAIL_BATCH_SIZE)
+    if not emails:
+        return 0, 0
+
+    groups = [list(group) for _, group in groupby(emails, key=lambda email: email.to_email)]
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        logger.warning(f"SMTPサーバーに接続できませんでした: {e}")
+        _retry_later(emails, e)
+        return 0, len(groups)
+
+    sent, failed = [], 0
+    try:
+        for group in groups:
+            try:
+                connection.send_messages([_build_message(group, connection)])
+            except Exception as e:
+                logger.warning(f"メールの送信に失敗しました: to={group[0].to_email}, {e}")
+                _retry_later(group, e)
+                failed += 1
+            else:
+                sent.extend(email.pk for email in group)
+    finally:
+        connection.close()
+
+    OutgoingEmail.objects.filter(pk__in=sent).update(
+        status=OutgoingEmail.STATUS_SENT, sent_at=timezone.now(), last_error=""
+    )
+    return len(groups) - failed, failed
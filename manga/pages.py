@@ -0,0 +1,61 @@
+"""
+ページの追加（create_page / continue_page / 管理画面で共通）
+
+ページを1つ足すのに必要な更新を、1つのトランザクションの中で決まった数のクエリで行う。
+
+- ページの INSERT（祖先パスと深さは signals.set_page_path が親から決める）
+- 祖先ページの子孫数・優先度の UPDATE（1クエリ、1ページ目なら不要）
+- マンガの updated_at とツリーのバージョンの UPDATE（1クエリ）
+- 親ページへの自分宛ての未達成バトンを完了にする UPDATE（1クエリ、更新した件数をそのまま使う）
+
+ツリーのキャッシュの引き継ぎと未達成バトン数の数え直しはコミット後に行う。
+"""
+from django.db import transaction
+
+from . import ai
+from .batons import refresh_pending_counts_on_commit
+from .models import Baton
+from .tree import bump_tree_version, extend_cached_tree
+
+
+class DraftUnavailable(Exception):
+    """使おうとした AI 生成の下書きが見つからない（他のページで使用済み・削除済みなど）"""
+
+
+def add_page(page, manga, author, parent=None, draft_id=""):
+    """
+    page（保存前のインスタンス）をページとして追加し、完了にしたバトンの数を返す
+    draft_id があれば、AI生成の下書き画像をアップロードし直さずにそのまま使う
+    （使えなければ DraftUnavailable を送出し、何も保存しない）
+    """
+    page.manga = manga
+    page.author = author
+    page.parent = parent
+
+    with transaction.atomic():
+        draft = None
+        if draft_id:
+            draft = ai.claim_draft(author, draft_id, parent) if draft_id.isdigit() else None
+            if draft is None:
+                raise DraftUnavailable(draft_id)
+            page.image = ai.draft_page_image(draft)
+
+        page.save()
+        if draft is not None:
+            ai.use_draft(draft, page)
+
+        page.update_ancestor_aggregates(descendants=1, priority=1 + page.likes)
+
+        # ツリーのバージョンも同時に上げ、キャッシュ済みのツリーがあればコミット後にページを足して引き継ぐ
+        version = bump_tree_version(manga.id, touch=True)
+        if version is not None:
+            transaction.on_commit(lambda: extend_cached_tree(page, version))
+
+        completed = 0
+        if parent is not None:
+            completed = Baton.objects.filter(
+                page=parent, to_user=author, is_completed=False
+            ).update(is_completed=True)
+            if completed:
+                refresh_pending_counts_on_commit([author.pk])
+    return completed
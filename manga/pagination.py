@@ -0,0 +1,56 @@
+"""
+キーセット（カーソル）方式のページネーション
+
+OFFSET を使わず「最後に表示した行の (時刻, id) より後ろ」を取得するので、
+何ページ目でもインデックスをたどるだけで済み、途中で行が増えてもずれない。
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+def encode_cursor(moment, pk):
+    raw = f"{moment.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """カーソル文字列を (時刻, id) に戻す。不正な値なら None"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        moment, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(moment), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def _value(item, field):
+    return item[field] if isinstance(item, dict) else getattr(item, field)
+
+
+def paginate_keyset(queryset, cursor, size, time_field, id_field='id'):
+    """
+    (time_field, id_field) の降順で size 件を返す
+
+    queryset はモデルでも values() でもよい。
+    戻り値は (items, next_cursor)。続きがなければ next_cursor は None
+    """
+    position = decode_cursor(cursor)
+    if position is not None:
+        moment, pk = position
+        queryset = queryset.filter(
+            Q(**{f"{time_field}__lt": moment})
+            | Q(**{time_field: moment, f"{id_field}__lt": pk})
+        )
+
+    items = list(queryset.order_by(f"-{time_field}", f"-{id_field}")[:size + 1])
+
+    next_cursor = None
+    if len(items) > size:
+        items = items[:size]
+        last = items[-1]
+        next_cursor = encode_cursor(_value(last, time_field), _value(last, id_field))
+    return items, next_cursor
@@ -1,32 +1,52 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from django.utils import timezone
 from .models import Page, Baton, UserProfile
+from .tree import bump_tree_version
+from .batons import refresh_pending_counts_on_commit
 from django.contrib.auth.models import User
 
-@receiver(post_save, sender=Page)
-def update_manga_timestamp(sender, instance, created, **kwargs):
+@receiver(pre_save, sender=Page)
+def set_page_path(sender, instance, **kwargs):
     """
-    Page が新規作成された場合のみ、親の Manga の updated_at を更新する
+    新規ページの祖先パスと深さを親ページから決める
+    （ページ追加に伴うほかの更新は pages.add_page がまとめて行う）
     """
-    if created:
-        manga = instance.manga
-        manga.updated_at = timezone.now()
-        manga.save(update_fields=["updated_at"])
+    if instance._state.adding:
+        parent = instance.parent
+        if parent:
+            instance.path = parent.subtree_path
+            instance.depth = parent.depth + 1
+        else:
+            instance.path = ""
+            instance.depth = 0
+        instance.subtree_priority = instance.likes
+        instance.descendant_count = 0
+
+
+@receiver(post_delete, sender=Page)
+def remove_from_ancestor_aggregates(sender, instance, **kwargs):
+    """
+    削除されたページの分だけ祖先の子孫数・優先度を減らす
+    （CASCADEで消えた子孫もそれぞれ自分の分だけ差し引くので二重にならない）
+    """
+    instance.update_ancestor_aggregates(descendants=-1, priority=-(1 + instance.likes))
+
+
+@receiver(post_delete, sender=Page)
+def invalidate_tree_on_delete(sender, instance, **kwargs):
+    """
+    ページが削除されたらツリーのキャッシュを無効にする
+    """
+    bump_tree_version(instance.manga_id)
 
 
-@receiver(post_save, sender=Page)
-def complete_batons(sender, instance, created, **kwargs):
+@receiver(post_save, sender=Baton)
+@receiver(post_delete, sender=Baton)
+def refresh_pending_baton_count(sender, instance, **kwargs):
     """
-    新しいページが追加されたら、親ページへのバトンを完了にする
+    バトンが作られた・更新された・消えたら、受け取ったユーザーの未達成バトン数を数え直す
     """
-    if created and instance.parent:
-        # 親ページへの未完了バトンを完了にする
-        Baton.objects.filter(
-            page=instance.parent,
-            to_user=instance.author,
-            is_completed=False
-        ).update(is_completed=True)
+    refresh_pending_counts_on_commit([instance.to_user_id])
 
 
 @receiver(post_save, sender=User)
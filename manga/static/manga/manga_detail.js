@@ -18,17 +18,10 @@ document.addEventListener("DOMContentLoaded", () => {
     const data = { nodes, edges };
 
     const options = {
+        // 座標（x, y）はサーバーで計算済みなので、ブラウザではレイアウト計算をしない
         layout: {
-            hierarchical: {
-                enabled: true,
-                direction: "UD",
-                sortMethod: "directed",
-                levelSeparation: 150,
-                nodeSpacing: 120,
-                blockShifting: false,
-                edgeMinimization: false,
-                parentCentralization: false
-            }
+            hierarchical: { enabled: false },
+            improvedLayout: false
         },
         physics: { enabled: false },
 
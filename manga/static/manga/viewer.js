@@ -45,9 +45,9 @@ document.addEventListener("DOMContentLoaded", () => {
         const counter = document.getElementById("page-counter");
         counter.textContent = `${newIndex + 1} / ${pages.length}`;
 
-        // うぃーねの状態
+        // うぃーねの状態（サーバーの記録を優先し、旧来の localStorage も見る）
         const storageKey = `liked_page_${page.id}`;
-        if (localStorage.getItem(storageKey)) {
+        if (page.liked || localStorage.getItem(storageKey)) {
             likeButton.disabled = true;
             likeButton.textContent = "👍 うぃーね済み";
         } else {
@@ -138,7 +138,7 @@ document.addEventListener("DOMContentLoaded", () => {
         const currentPage = pages[currentIndex];
         const storageKey = `liked_page_${currentPage.id}`;
 
-        if (localStorage.getItem(storageKey)) return;
+        if (currentPage.liked || localStorage.getItem(storageKey)) return;
 
         fetch(this.action, {
             method: "POST",
@@ -150,6 +150,8 @@ document.addEventListener("DOMContentLoaded", () => {
             .then((res) => res.json())
             .then((data) => {
                 likeCount.textContent = data.likes;
+                currentPage.likes = data.likes;
+                currentPage.liked = data.liked;
                 localStorage.setItem(storageKey, "1");
                 likeButton.disabled = true;
                 likeButton.textContent = "👍 うぃーね済み";
@@ -183,42 +185,77 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     });
 
-    // ツリーネットワークを初期化
-    function initTreeNetwork() {
-        const nodes = new vis.DataSet(window.treeNodes.map(n => {
-            const isCurrentPage = n.id === pages[currentIndex].id;
+    // サーバーのノードデータを vis.js のノードに変換
+    function toVisNode(n) {
+        // 折りたたみノード（隠れているページ数を表示）
+        if (n.stub) {
             return {
                 ...n,
-                image: n.imageUrl,
-                shape: "image",
-                size: 50,
-                borderWidth: isCurrentPage ? 3 : 1,
-                color: {
-                    border: isCurrentPage ? '#22c55e' : '#999',
-                    background: isCurrentPage ? '#22c55e' : '#ffffff'
-                },
-                shapeProperties: {
-                    useBorderWithImage: true
-                }
+                label: `+${n.hidden}`,
+                shape: "box",
+                color: { border: "#999", background: "#f3f4f6" },
+                font: { size: 20, color: "#374151" }
             };
-        }));
+        }
 
-        const edges = new vis.DataSet(window.treeEdges);
+        const isCurrentPage = n.id === pages[currentIndex].id;
+        return {
+            ...n,
+            image: n.imageUrl,
+            shape: "image",
+            size: 50,
+            borderWidth: isCurrentPage ? 3 : 1,
+            color: {
+                border: isCurrentPage ? '#22c55e' : '#999',
+                background: isCurrentPage ? '#22c55e' : '#ffffff'
+            },
+            shapeProperties: {
+                useBorderWithImage: true
+            }
+        };
+    }
+
+    // エッジは from-to を id にして、展開時に重複しないようにする
+    function toVisEdge(e) {
+        return { ...e, id: `${e.from}-${e.to}` };
+    }
+
+    // ツリーネットワークを初期化
+    function initTreeNetwork() {
+        const nodes = new vis.DataSet(window.treeNodes.map(toVisNode));
+        const edges = new vis.DataSet(window.treeEdges.map(toVisEdge));
+
+        // 折りたたみノードを展開（部分ツリーを取得して追加）
+        function expandStub(stub) {
+            fetch(`/page/${stub.parent}/subtree/`)
+                .then((res) => res.json())
+                .then((data) => {
+                    const returnedIds = new Set(data.nodes.map(n => n.id));
+
+                    nodes.remove(stub.id);
+                    edges.remove(`${stub.parent}-${stub.id}`);
+
+                    // 取得した範囲で隠れていない子を持つページの古い折りたたみノードを消す
+                    data.nodes.forEach(n => {
+                        const stubId = `more-${n.id}`;
+                        if (!n.stub && !returnedIds.has(stubId) && nodes.get(stubId)) {
+                            nodes.remove(stubId);
+                            edges.remove(`${n.id}-${stubId}`);
+                        }
+                    });
+
+                    nodes.update(data.nodes.map(toVisNode));
+                    edges.update(data.edges.map(toVisEdge));
+                });
+        }
 
         const data = { nodes, edges };
 
         const options = {
+            // 座標（x, y）はサーバーで計算済みなので、ブラウザではレイアウト計算をしない
             layout: {
-                hierarchical: {
-                    enabled: true,
-                    direction: "UD",
-                    sortMethod: "directed",
-                    levelSeparation: 150,
-                    nodeSpacing: 120,
-                    blockShifting: false,
-                    edgeMinimization: false,
-                    parentCentralization: false
-                }
+                hierarchical: { enabled: false },
+                improvedLayout: false
             },
             physics: { enabled: false },
             nodes: {
@@ -251,13 +288,20 @@ document.addEventListener("DOMContentLoaded", () => {
             const node = nodes.get(params.node);
             if (!node) return;
 
-            const title = node.title || "タイトル不明";
-            const author = node.author || "作者不明";
-
-            treeTooltip.innerHTML = `
-                <div style="font-weight:bold;">${title}</div>
-                <div style="color:#666;">${author}</div>
-            `;
+            if (node.stub) {
+                treeTooltip.innerHTML = `
+                    <div style="font-weight:bold;">ほか ${node.hidden} ページ</div>
+                    <div style="color:#666;">クリックで展開</div>
+                `;
+            } else {
+                const title = node.title || "タイトル不明";
+                const author = node.author || "作者不明";
+
+                treeTooltip.innerHTML = `
+                    <div style="font-weight:bold;">${title}</div>
+                    <div style="color:#666;">${author}</div>
+                `;
+            }
             treeTooltip.style.left = params.event.pageX + 10 + "px";
             treeTooltip.style.top = params.event.pageY + 10 + "px";
             treeTooltip.style.display = "block";
@@ -271,6 +315,11 @@ document.addEventListener("DOMContentLoaded", () => {
         treeNetwork.on("click", (params) => {
             if (params.nodes.length > 0) {
                 const nodeId = params.nodes[0];
+                const node = nodes.get(nodeId);
+                if (node && node.stub) {
+                    expandStub(node);
+                    return;
+                }
                 window.location.href = `/page/${nodeId}/viewer/`;
             }
         });
@@ -297,7 +346,8 @@ document.addEventListener("DOMContentLoaded", () => {
         if (!treeNetwork) return;
 
         const nodes = treeNetwork.body.data.nodes;
-        const allNodeIds = nodes.getIds();
+        // 折りたたみノードは見た目を変えない
+        const allNodeIds = nodes.getIds({ filter: n => !n.stub });
         
         // すべてのノードを通常の状態に戻す
         allNodeIds.forEach(nodeId => {
@@ -312,6 +362,9 @@ document.addEventListener("DOMContentLoaded", () => {
             });
         });
 
+        // ウィンドウ表示で現在のページがツリーに含まれていない場合は何もしない
+        if (!nodes.get(pageId)) return;
+
         // 現在のページを強調表示
         nodes.update({
             id: pageId,
@@ -1,3 +1,930 @@
-from django.test import TestCase
+import json
+import os
+import random
+import tempfile
+from collections import OrderedDict
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings as django_settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import admission, ai, batons, checks, likes, outbox, pages, tree
+from .models import AIDraft, AIGenerationJob, Baton, Manga, OutgoingEmail, Page, PageLike, UserProfile
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'SQLite と PostgreSQL の実行計画だけを確認する')
+class HotQueryIndexTests(TestCase):
+    """よく使う絞り込みが、そのために作ったインデックスを使うこと"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='p')
+        cls.receiver = User.objects.create_user(username='receiver', password='p')
+        cls.manga = Manga.objects.create(title='m', created_by=cls.author)
+        cls.root = Page.objects.create(manga=cls.manga, author=cls.author, image='x')
+        cls.page = Page.objects.create(manga=cls.manga, author=cls.author, image='x', parent=cls.root)
+        Baton.objects.create(page=cls.root, from_user=cls.author, to_user=cls.receiver)
+        Baton.objects.create(
+            page=cls.page, from_user=cls.author, to_user=cls.receiver, is_completed=True
+        )
+
+    def assertUsesIndex(self, queryset, index_name):
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # 行が少ないと全件走査のほうが安くなるので、インデックスを使えるかだけを見る
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_pending_baton_count(self):
+        """ヘッダーの未達成バトン数（context_processors / batons）"""
+        queryset = (
+            Baton.objects.filter(to_user_id__in=[self.receiver.id], is_completed=False)
+            .order_by()
+            .values_list('to_user', 'page')
+            .distinct()
+        )
+        self.assertUsesIndex(queryset, 'baton_pending_inbox_idx')
+
+    def test_baton_inbox_groups(self):
+        """マイページのページごとにまとめたバトン（未達成・達成済み）"""
+        for completed, index_name in [
+            (False, 'baton_pending_inbox_idx'),
+            (True, 'baton_completed_inbox_idx'),
+        ]:
+            with self.subTest(completed=completed):
+                queryset = Baton.objects.filter(
+                    to_user=self.receiver, is_completed=completed
+                ).values('page').annotate(count=Count('id'), latest_date=Max('created_at'))
+                self.assertUsesIndex(queryset, index_name)
+
+    def test_complete_batons(self):
+        """ページ追加時に親ページへのバトンを完了にする（pages.add_page）"""
+        queryset = Baton.objects.filter(
+            page=self.root, to_user=self.receiver, is_completed=False
+        )
+        self.assertUsesIndex(queryset, 'baton_pending_inbox_idx')
+
+    def test_root_page_exists(self):
+        """1ページ目があるかの確認（create_page）"""
+        queryset = self.manga.pages.filter(parent__isnull=True)
+        self.assertUsesIndex(queryset, 'page_manga_root_idx')
+
+    def test_manga_list(self):
+        """マンガ一覧（更新日時の新しい順、views._manga_list_page）"""
+        queryset = Manga.objects.filter(
+            Q(updated_at__lt=self.manga.updated_at) | Q(updated_at=self.manga.updated_at, id__lt=self.manga.id)
+        ).order_by('-updated_at', '-id')[:25]
+        self.assertUsesIndex(queryset, 'manga_updated_idx')
+
+    def test_my_pages(self):
+        """マイページの描いたページ（新しい順）"""
+        queryset = Page.objects.filter(author=self.author).order_by('-created_at', '-id')
+        self.assertUsesIndex(queryset, 'page_author_created_idx')
+
+
+class AddPageTests(TestCase):
+    """ページの追加（pages.add_page）が、決まった数のクエリでまとめて更新すること"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='p')
+        cls.receiver = User.objects.create_user(username='receiver', password='p')
+        cls.manga = Manga.objects.create(title='m', created_by=cls.author)
+        cls.root = Page(image='x')
+        pages.add_page(cls.root, cls.manga, cls.author)
+        cls.page = Page(image='x')
+        pages.add_page(cls.page, cls.manga, cls.author, cls.root)
+
+    def test_root_page(self):
+        # SAVEPOINT, INSERT, マンガの UPDATE, RELEASE（祖先もバトンもない）
+        manga = Manga.objects.create(title='n', created_by=self.author)
+        page = Page(image='x')
+        with self.assertNumQueries(4):
+            completed = pages.add_page(page, manga, self.author)
+        self.assertEqual(completed, 0)
+        self.assertEqual((page.path, page.depth), ('', 0))
+
+    def test_continued_page(self):
+        Baton.objects.create(page=self.page, from_user=self.author, to_user=self.receiver)
+        Baton.objects.create(page=self.page, from_user=self.author, to_user=self.receiver)
+        version = Manga.objects.get(pk=self.manga.pk).tree_version
+
+        # SAVEPOINT, INSERT, 祖先の UPDATE, マンガの UPDATE, バトンの UPDATE, RELEASE
+        page = Page(image='x')
+        with self.assertNumQueries(6):
+            completed = pages.add_page(page, self.manga, self.receiver, self.page)
+
+        self.assertEqual(completed, 2)
+        self.assertFalse(Baton.objects.filter(to_user=self.receiver, is_completed=False).exists())
+        self.assertEqual((page.path, page.depth), (f'{self.root.pk}/{self.page.pk}/', 2))
+        self.assertEqual(Manga.objects.get(pk=self.manga.pk).tree_version, version + 1)
+        self.assertEqual(
+            list(Page.objects.filter(pk__in=[self.root.pk, self.page.pk])
+                 .order_by('depth').values_list('descendant_count', 'subtree_priority')),
+            [(2, 2), (1, 1)],
+        )
+
+    def test_unavailable_draft(self):
+        """使えない下書きを指定したら何も保存しない"""
+        with self.assertRaises(pages.DraftUnavailable):
+            pages.add_page(Page(), self.manga, self.receiver, self.page, draft_id='999')
+        self.assertEqual(self.manga.pages.count(), 2)
+
+    def test_admin_cannot_edit_maintained_fields(self):
+        """管理画面では、追加後に親を付け替えたり、祖先パスや集計を書き換えたりできない"""
+        request = RequestFactory().get('/')
+        request.user = User.objects.create_superuser(username='admin', password='p')
+        page_admin = admin.site._registry[Page]
+
+        add_fields = page_admin.get_form(request)().fields
+        self.assertIn('parent', add_fields)
+        change_fields = page_admin.get_form(request, self.page)().fields
+        self.assertIn('title', change_fields)
+        for field in ('manga', 'parent', 'likes', 'path', 'depth', 'subtree_priority', 'descendant_count'):
+            with self.subTest(field=field):
+                self.assertNotIn(field, change_fields)
+                if field not in ('manga', 'parent', 'likes'):
+                    self.assertNotIn(field, add_fields)
+
+
+class AIDedupTests(TestCase):
+    """同じ内容の生成リクエストの使い回し（ai.dedup_key / ai.find_duplicate）"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user', password='p')
+        manga = Manga.objects.create(title='m', created_by=cls.user)
+        cls.first = Page.objects.create(manga=manga, author=cls.user, image='x')
+        cls.second = Page.objects.create(manga=manga, author=cls.user, image='x', parent=cls.first)
+
+    def test_same_parent_reuses_job(self):
+        key = ai.dedup_key(self.first.id, 'hi')
+        job = ai.enqueue(self.user, self.first, 'hi', False, key=key)
+        self.assertEqual(ai.find_duplicate(self.user, self.first, ai.dedup_key(self.first.id, ' ｈｉ ')), job)
+
+    def test_other_parent_does_not_reuse_job(self):
+        """参照画像を使わなくても、下書きは親ページごとなので別の親ページには使い回さない"""
+        key = ai.dedup_key(self.first.id, 'hi')
+        ai.enqueue(self.user, self.first, 'hi', False, key=key)
+        other = ai.dedup_key(self.second.id, 'hi')
+        self.assertNotEqual(key, other)
+        self.assertIsNone(ai.find_duplicate(self.user, self.second, other))
+        self.assertIsNone(ai.find_duplicate(self.user, self.second, key))
+
+
+class AIJobEventsTests(TestCase):
+    """SSE（views.ai_job_events）が、ジョブの完了を待たずにイベントを1通ずつ流すこと"""
+
+    def test_streams_before_job_finishes(self):
+        user = User.objects.create_user(username='user', password='p')
+        manga = Manga.objects.create(title='m', created_by=user)
+        parent = Page.objects.create(manga=manga, author=user, image='x')
+        job = ai.enqueue(user, parent, 'hi', False, stream=True)
+        AIGenerationJob.objects.filter(pk=job.pk).update(
+            status=AIGenerationJob.STATUS_RUNNING, partial_image='abc', partial_count=1
+        )
+        self.client.force_login(user)
+
+        # テストクライアントは WSGI と同じく同期でレスポンスを読む
+        response = self.client.get(f'/ai-jobs/{job.id}/events/')
+        self.assertFalse(response.is_async)
+        events = iter(response.streaming_content)
+        self.assertEqual(next(events), b'retry: 1000\n\n')
+        self.assertTrue(next(events).startswith(b'event: status'))
+        self.assertTrue(next(events).startswith(b'event: frame\nid: 1'))
+        response.close()
+
+
+class FakeBackendDraftTests(TransactionTestCase):
+    """FakeBackend の生成はネットワークを使わず、下書きもローカルに置くこと"""
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        settings = self.settings(
+            AI_BACKEND='manga.ai_backends.FakeBackend', AI_DRAFT_STORE='',
+            AI_FAKE_LATENCY=0, AI_FAKE_FAILURE_RATE=0, MEDIA_ROOT=self.media.name,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # プロセスで使い回しているバックエンドと置き場所を作り直させる
+        for name in ('_backend', '_draft_store'):
+            patcher = mock.patch.object(ai, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_run_job_stores_drafts_locally(self):
+        user = User.objects.create_user(username='user', password='p')
+        manga = Manga.objects.create(title='m', created_by=user)
+        parent = Page.objects.create(manga=manga, author=user, image='x')
+        ai.enqueue(user, parent, 'hi', False, candidates=2)
+        job = ai.claim_next_job()
+
+        with mock.patch('cloudinary.uploader.upload_resource') as upload:
+            ai.run_job(job)
+        upload.assert_not_called()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AIGenerationJob.STATUS_SUCCEEDED)
+        drafts = ai.job_status(job)['drafts']
+        self.assertEqual(len(drafts), 2)
+        for draft in drafts:
+            path = draft['image_url'].removeprefix(django_settings.MEDIA_URL)
+            self.assertTrue(os.path.exists(os.path.join(self.media.name, path)))
+
+        self.assertEqual(ai.delete_expired_drafts(ttl=-1), 2)
+        self.assertEqual(os.listdir(os.path.join(self.media.name, 'ai_drafts')), [])
+
+
+class StaleJobTests(TransactionTestCase):
+    """時間切れで失敗にされたジョブ（ai.fail_stale_jobs）のスレッドが、後から終わったとき"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='user', password='p')
+        manga = Manga.objects.create(title='m', created_by=user)
+        parent = Page.objects.create(manga=manga, author=user, image='x')
+        self.job = ai.enqueue(user, parent, 'hi', False)
+        AIGenerationJob.objects.filter(pk=self.job.pk).update(
+            status=AIGenerationJob.STATUS_RUNNING, started_at=timezone.now() - timedelta(hours=1)
+        )
+
+    def run_stale_job(self, slot):
+        def generate(*args, **kwargs):
+            ai.fail_stale_jobs(timeout=60)
+            return ['png']
+
+        store = mock.Mock(save=mock.Mock(return_value='ai_drafts/x'))
+        with mock.patch.object(ai, 'get_backend', return_value=mock.Mock(generate=generate)), \
+                mock.patch.object(ai, 'get_draft_store', return_value=store):
+            ai.run_job(self.job, slot)
+        return store
+
+    def test_result_does_not_revive_job(self):
+        store = self.run_stale_job(slot=None)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, AIGenerationJob.STATUS_FAILED)
+        # 保存した下書きは使われないので消す
+        store.delete.assert_called_once()
+        self.assertFalse(AIDraft.objects.exists())
+
+    def test_expired_slot_is_not_released(self):
+        """切れた枠を別のジョブが取っていたら、その枠は消さない"""
+        cache.clear()
+        with self.settings(AI_MAX_CONCURRENT=1):
+            slot = admission.acquire_slot()
+            cache.delete(admission.SLOT_KEY.format(index=0))  # AI_JOB_TIMEOUT で切れた
+            other = admission.acquire_slot()
+            self.run_stale_job(slot)
+            self.assertIsNone(admission.acquire_slot())
+            admission.release_slot(other)
+            self.assertIsNotNone(admission.acquire_slot())
+
+
+class TreePayloadCacheTests(TestCase):
+    """ツリービュー用の JSON は共有キャッシュから、ツリーはプロセスのメモリから返すこと"""
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(tree, '_trees', OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_payload_cache_hit_skips_tree(self):
+        user = User.objects.create_user(username='user', password='p')
+        manga = Manga.objects.create(title='m', created_by=user)
+        root = Page(image='x')
+        pages.add_page(root, manga, user)
+        pages.add_page(Page(image='x'), manga, user, root)
+        manga.refresh_from_db()
+
+        count, nodes_json, edges_json = tree.get_tree_payload(manga)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(json.loads(edges_json)), 1)
+
+        tree._trees.clear()
+        with self.assertNumQueries(0), mock.patch.object(tree, 'get_tree') as get_tree:
+            self.assertEqual(tree.get_tree_payload(manga), (count, nodes_json, edges_json))
+        get_tree.assert_not_called()
+
+        # ツリーはプロセスに置くので、2回目は読み込まない
+        loaded = tree.get_tree(manga)
+        with self.assertNumQueries(0):
+            self.assertIs(tree.get_tree(manga), loaded)
+
+    @override_settings(LIKE_FLUSH_INTERVAL=60)
+    def test_likes_keep_payload_and_update_local_tree(self):
+        user = User.objects.create_user(username='user', password='p')
+        manga = Manga.objects.create(title='m', created_by=user)
+        root = Page(image='x')
+        pages.add_page(root, manga, user)
+        first = Page(image='x')
+        pages.add_page(first, manga, user, root)
+        second = Page(image='x')
+        pages.add_page(second, manga, user, root)
+        manga.refresh_from_db()
+        payload = tree.get_tree_payload(manga)
+        before = tree.get_tree(manga)
+        self.assertEqual(before.best_path(root.id, 2), [root.id, first.id])
+
+        with mock.patch.object(likes, '_schedule_flush'):
+            likes.add_like(second, likes.Viewer(user.id, ""))
+        with self.captureOnCommitCallbacks(execute=True):
+            likes.flush()
+        manga.refresh_from_db()
+
+        # ページの構成は変わらないので、ツリービュー用の JSON もツリーも読み込み直さない
+        with self.assertNumQueries(0):
+            self.assertEqual(tree.get_tree_payload(manga), payload)
+            updated = tree.get_tree(manga)
+        self.assertIsNot(updated, before)
+        self.assertEqual(updated.best_path(root.id, 2), [root.id, second.id])
+        self.assertEqual(updated.priorities[updated.index[root.id]], 2 + 1)  # 子2ページ + うぃーね1
+        # 読んでいる途中のリクエストのツリーは変わらない
+        self.assertEqual(before.best_path(root.id, 2), [root.id, first.id])
+
+        # ほかのプロセス（古いツリーを持っている）は、うぃーね数だけを読み直す
+        tree._trees[manga.id] = before
+        with self.assertNumQueries(1):
+            reloaded = tree.get_tree(manga)
+        full = tree.MangaTree.load(manga.id)
+        self.assertEqual(reloaded.priorities, full.priorities)
+        self.assertEqual(reloaded.best_child, full.best_child)
+        self.assertEqual(reloaded.version, manga.tree_version)
+
+
+class AdmissionTests(TestCase):
+    """AI画像生成の待ち順（ai.queue_position）と、共有キャッシュの設定チェック"""
+
+    def test_queue_position_follows_turn_order(self):
+        users = [User.objects.create_user(username=f'user{i}', password='p') for i in range(3)]
+        manga = Manga.objects.create(title='m', created_by=users[0])
+        parent = Page.objects.create(manga=manga, author=users[0], image='x')
+        jobs = [ai.enqueue(users[i], parent, 'hi', False) for i in [0, 0, 0, 1, 2, 1]]
+
+        # ユーザーごとに交互に回ってくる: 0, 1, 2, 0, 1, 0
+        expected = [jobs[0], jobs[3], jobs[4], jobs[1], jobs[5], jobs[2]]
+        for position, job in enumerate(expected):
+            with self.subTest(job=job.id), self.assertNumQueries(1):
+                self.assertEqual(ai.queue_position(job), position)
+
+    def test_shared_cache_required_for_ai(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        backend = mock.Mock(available=mock.Mock(return_value=True))
+        with mock.patch.object(ai, 'get_backend', return_value=backend):
+            with self.settings(CACHES=locmem, DEBUG=False):
+                self.assertEqual([e.id for e in checks.ai_shared_cache_check(None)], ['manga.E001'])
+            with self.settings(CACHES=locmem, DEBUG=True):
+                self.assertEqual([e.id for e in checks.ai_shared_cache_check(None)], ['manga.W001'])
+            backend.available.return_value = False
+            with self.settings(CACHES=locmem, DEBUG=False):
+                self.assertEqual(checks.ai_shared_cache_check(None), [])
+
+
+class LikesTests(TestCase):
+    """うぃーねのバッファと二重押しの判定（likes）"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='p')
+        manga = Manga.objects.create(title='m', created_by=self.user)
+        self.root = Page(image='x')
+        pages.add_page(self.root, manga, self.user)
+        self.page = Page(image='x')
+        pages.add_page(self.page, manga, self.user, self.root)
+        self.viewer = likes.Viewer(self.user.id, "")
+
+    def refreshed(self, page):
+        return Page.objects.get(pk=page.pk)
+
+    @override_settings(LIKE_FLUSH_INTERVAL=60)
+    def test_flush_applies_buffered_likes_once_per_viewer(self):
+        other = likes.Viewer(None, 'session')
+        with mock.patch.object(likes, '_schedule_flush'):
+            self.assertEqual(likes.add_like(self.page, self.viewer), (1, True))
+            self.assertEqual(likes.add_like(self.page, self.viewer), (1, False))
+            self.assertEqual(likes.add_like(self.page, other), (2, True))
+        # DB にはまだ書いていない
+        self.assertEqual(self.refreshed(self.page).likes, 0)
+        self.assertEqual(likes.path_state(self.viewer, [self.page.id])[0], {self.page.id: 2})
+
+        likes.flush()
+        page = self.refreshed(self.page)
+        self.assertEqual((page.likes, page.subtree_priority), (2, 2))
+        self.assertEqual(self.refreshed(self.root).subtree_priority, 1 + 2)  # 子1ページ + 子の優先度
+        self.assertEqual(PageLike.objects.filter(page=self.page).count(), 2)
+        self.assertEqual(likes.path_state(self.viewer, [self.page.id]), ({self.page.id: 0}, {self.page.id}))
+
+    @override_settings(LIKE_FLUSH_INTERVAL=60)
+    def test_buffered_viewer_not_counted_after_dedup_key_evicted(self):
+        with mock.patch.object(likes, '_schedule_flush'):
+            self.assertEqual(likes.add_like(self.page, self.viewer), (1, True))
+            # 判定用のキーが追い出されても、バッファにあるので数えない
+            cache.delete(likes.liked_key(self.viewer, self.page.id))
+            self.assertEqual(likes.add_like(self.page, self.viewer), (1, False))
+        self.assertEqual(cache.get(likes.pending_key(self.page.id)), 1)
+
+        likes.flush()
+        self.assertEqual(self.refreshed(self.page).likes, 1)
+        self.assertEqual(cache.get(likes.pending_key(self.page.id)), 0)
+
+    @override_settings(LIKE_FLUSH_INTERVAL=60)
+    def test_flush_counts_only_inserted_records(self):
+        """別のプロセスが同じ閲覧者の記録を先に入れていたら、Page.likes は増やさない"""
+        with mock.patch.object(likes, '_schedule_flush'):
+            likes.add_like(self.page, self.viewer)
+        PageLike.objects.create(page=self.page, user=self.user)
+
+        with mock.patch.object(likes, '_existing_likes', return_value=set()):
+            likes.flush()
+        self.assertEqual(self.refreshed(self.page).likes, 0)
+        self.assertEqual(PageLike.objects.filter(page=self.page).count(), 1)
+
+
+class BranchesBatchTests(TestCase):
+    """分岐の一括取得（views.page_branches_batch_json）がビューアと同じツリーを使うこと"""
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(tree, '_trees', OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = User.objects.create_user(username='user', password='p')
+        self.manga = Manga.objects.create(title='m', created_by=user)
+        self.root = Page(image='x')
+        pages.add_page(self.root, self.manga, user)
+        # 同点の子は id の小さいほうをたどる
+        self.first = Page(image='x')
+        pages.add_page(self.first, self.manga, user, self.root)
+        self.second = Page(image='x')
+        pages.add_page(self.second, self.manga, user, self.root)
+        self.leaf = Page(image='x')
+        pages.add_page(self.leaf, self.manga, user, self.first)
+        self.manga.refresh_from_db()
+
+    def test_start_follows_viewer_path(self):
+        loaded = tree.get_tree(self.manga)
+        # ツリーがキャッシュにあれば、ページとマンガを読む1クエリだけ
+        with self.assertNumQueries(1):
+            response = self.client.get('/pages/branches/', {'start': self.root.id, 'depth': 5})
+        data = response.json()
+
+        viewer_path = [loaded.ids[pos] for pos in loaded.reading_path(self.root.id)]
+        self.assertEqual(data['pages'], viewer_path)
+        self.assertEqual(data['pages'], [self.root.id, self.first.id, self.leaf.id])
+        self.assertEqual(
+            [branch['id'] for branch in data['branches'][str(self.root.id)]],
+            [self.first.id, self.second.id],
+        )
+        self.assertEqual(data['branches'][str(self.leaf.id)], [])
+
+    def test_ids(self):
+        response = self.client.get('/pages/branches/', {'ids': f'{self.first.id},{self.second.id},999'})
+        data = response.json()
+        self.assertEqual(data['pages'], [self.first.id, self.second.id, 999])
+        self.assertEqual([branch['id'] for branch in data['branches'][str(self.first.id)]], [self.leaf.id])
+        self.assertEqual(data['branches'][str(self.second.id)], [])
+        self.assertEqual(data['branches']['999'], [])
+
+    def test_ids_from_several_mangas_rejected(self):
+        user = User.objects.get(username='user')
+        other = Page(image='x')
+        pages.add_page(other, Manga.objects.create(title='n', created_by=user), user)
+
+        response = self.client.get('/pages/branches/', {'ids': f'{self.first.id},{other.id}'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(tree._trees), 0)
+
+
+class MangaTreeAddPageTests(SimpleTestCase):
+    """キャッシュ済みのツリーにページを足したとき（MangaTree.add_page）、全体を計算し直した結果と一致すること"""
+
+    def snapshot(self, manga_tree):
+        return {
+            page_id: (
+                manga_tree.depths[pos],
+                manga_tree.priorities[pos],
+                manga_tree.descendants[pos],
+                manga_tree.ids[manga_tree.best_child[pos]] if manga_tree.best_child[pos] >= 0 else None,
+                manga_tree.xs[pos],
+                manga_tree.ys[pos],
+            )
+            for page_id, pos in manga_tree.index.items()
+        }
+
+    def test_matches_full_recompute(self):
+        rng = random.Random(0)
+        for trial in range(30):
+            with self.subTest(trial=trial):
+                rows = [(1, None, '', 'a', None, rng.randrange(3))]
+                depth = {1: 0}
+                for page_id in range(2, rng.randrange(2, 40)):
+                    parent_id = rng.choice(list(depth))
+                    depth[page_id] = depth[parent_id] + 1
+                    rows.append((page_id, parent_id, '', 'a', None, rng.randrange(3)))
+
+                # 最初の何ページかでツリーを作り、残りを1ページずつ足す
+                split = rng.randrange(1, len(rows) + 1)
+                original = tree.MangaTree(1, sorted(rows[:split], key=lambda row: (depth[row[0]], row[0])))
+                before = self.snapshot(original)
+                cached = original
+                for page_id, parent_id, title, author, image, page_likes in rows[split:]:
+                    # 読んでいる途中のリクエストがあるので、複製に足す
+                    cached = cached.copy()
+                    cached.add_page(SimpleNamespace(
+                        pk=page_id, parent_id=parent_id, title=title,
+                        author=SimpleNamespace(username=author), image=image, likes=page_likes,
+                    ))
+
+                full = tree.MangaTree(1, sorted(rows, key=lambda row: (depth[row[0]], row[0])))
+                self.assertEqual(self.snapshot(cached), self.snapshot(full))
+                self.assertEqual(self.snapshot(original), before)
+                self.assertEqual(len(original), split)
+
+
+class MangaTreeTests(TestCase):
+    """
+    ツリービュー・ビューアが使うページツリー（tree.MangaTree）
+      root
+      ├ a (2)
+      │ ├ c
+      │ └ d (1)
+      └ b (3)
+        └ e
+    （かっこ内はうぃーね数）
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username='user', password='p')
+        cls.manga = Manga.objects.create(title='m', created_by=user)
+
+        def add(parent=None, likes=0):
+            page = Page(image='x', likes=likes)
+            pages.add_page(page, cls.manga, user, parent)
+            return page
+
+        cls.root = add()
+        cls.a = add(cls.root, likes=2)
+        cls.b = add(cls.root, likes=3)
+        cls.c = add(cls.a)
+        cls.d = add(cls.a, likes=1)
+        cls.e = add(cls.b)
+
+    def setUp(self):
+        self.tree = tree.MangaTree.load(self.manga.id)
+
+    def ids(self, positions):
+        return [self.tree.ids[pos] for pos in positions]
+
+    def test_aggregates_match_denormalized_columns(self):
+        for page in Page.objects.filter(manga=self.manga):
+            with self.subTest(page=page.id):
+                pos = self.tree.index[page.id]
+                self.assertEqual(self.tree.priorities[pos], page.subtree_priority)
+                self.assertEqual(self.tree.descendants[pos], page.descendant_count)
+                self.assertEqual(self.tree.depths[pos], page.depth)
+        root = self.tree.index[self.root.id]
+        self.assertEqual((self.tree.priorities[root], self.tree.descendants[root]), (11, 5))
+
+    def test_reading_path(self):
+        """親をさかのぼり、優先度の高い子をたどる"""
+        self.assertEqual(self.ids(self.tree.reading_path(self.root.id)), [self.root.id, self.a.id, self.d.id])
+        self.assertEqual(self.ids(self.tree.reading_path(self.c.id)), [self.root.id, self.a.id, self.c.id])
+        self.assertEqual(self.ids(self.tree.reading_path(self.b.id)), [self.root.id, self.b.id, self.e.id])
+
+    def test_best_child_tie_breaks_on_smaller_id(self):
+        Page.objects.filter(pk=self.b.pk).update(likes=4)  # a と b の優先度がどちらも 5 になる
+        same = tree.MangaTree.load(self.manga.id)
+        a, b = same.index[self.a.id], same.index[self.b.id]
+        self.assertEqual(same.priorities[a], same.priorities[b])
+        self.assertEqual(same.ids[same.best_child[same.index[self.root.id]]], self.a.id)
+
+    def test_branches(self):
+        self.assertEqual(
+            [(branch['id'], branch['priority']) for branch in self.tree.branches(self.root.id)],
+            [(self.a.id, 5), (self.b.id, 4)],
+        )
+        self.assertEqual(self.tree.branches(self.e.id), [])
+
+    def stubs(self, payload):
+        return {node['parent']: node['hidden'] for node in payload['nodes'] if node.get('stub')}
+
+    def test_window_stubs(self):
+        """d の上下1段だけ：a の隠れた子 c を折りたたみノードにする"""
+        window = self.tree.window(self.d.id, 1)
+        pages_in_window = {node['id'] for node in window['nodes'] if not node.get('stub')}
+        self.assertEqual(pages_in_window, {self.a.id, self.d.id})
+        self.assertEqual(self.stubs(window), {self.a.id: 1})
+        self.assertIn({'from': self.a.id, 'to': self.d.id}, window['edges'])
+
+    def test_subtree_slice_stubs(self):
+        self.assertEqual(self.stubs(self.tree.subtree_slice(self.root.id, 1)), {self.a.id: 2, self.b.id: 1})
+        self.assertEqual(self.stubs(self.tree.subtree_slice(self.root.id, 2)), {})
+
+
+@override_settings(EMAIL_RETRY_DELAY=60, EMAIL_MAX_ATTEMPTS=2, EMAIL_SEND_TIMEOUT=300)
+class OutboxTests(TestCase):
+    """メールのアウトボックス（outbox.send_pending）の取り出し・まとめ・再送"""
+
+    def add_email(self, to_email='a@example.com', delay=0, **fields):
+        return OutgoingEmail.objects.create(
+            to_email=to_email, subject=f'subject {delay}', body='body', summary=f'summary {delay}',
+            url='https://example.com/my-page/',
+            next_attempt_at=timezone.now() + timedelta(seconds=delay), **fields
+        )
+
+    def test_digest_includes_waiting_emails(self):
+        """送る時刻になったメールと一緒に、同じ宛先のまとめ待ちのメールも1通にして送る"""
+        due = self.add_email(delay=-1)
+        waiting = self.add_email(delay=60)
+        single = self.add_email(to_email='b@example.com', delay=-1)
+        later = self.add_email(to_email='c@example.com', delay=60)
+
+        self.assertEqual(outbox.send_pending(), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        digest = next(message for message in mail.outbox if message.to == ['a@example.com'])
+        self.assertEqual(digest.subject, '【リレーマンガ】バトンが2件届きました')
+        self.assertIn('・summary -1\n・summary 60', digest.body)
+        self.assertIn('subject -1', [message.subject for message in mail.outbox if message.to == ['b@example.com']])
+
+        statuses = dict(OutgoingEmail.objects.values_list('id', 'status'))
+        self.assertEqual(statuses[due.id], OutgoingEmail.STATUS_SENT)
+        self.assertEqual(statuses[waiting.id], OutgoingEmail.STATUS_SENT)
+        self.assertEqual(statuses[single.id], OutgoingEmail.STATUS_SENT)
+        self.assertEqual(statuses[later.id], OutgoingEmail.STATUS_PENDING)
+
+    def test_sending_lease(self):
+        """送信中のメールは、EMAIL_SEND_TIMEOUT を過ぎるまで取り出さない"""
+        self.add_email(delay=100, status=OutgoingEmail.STATUS_SENDING, attempts=1)
+        expired = self.add_email(to_email='b@example.com', delay=-1, status=OutgoingEmail.STATUS_SENDING)
+
+        self.assertEqual(outbox.send_pending(), (1, 0))
+        self.assertEqual([message.to for message in mail.outbox], [['b@example.com']])
+        expired.refresh_from_db()
+        self.assertEqual(expired.status, OutgoingEmail.STATUS_SENT)
+
+    def test_retry_with_backoff_then_fail(self):
+        email = self.add_email(delay=-1)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=OSError('boom')):
+            self.assertEqual(outbox.send_pending(), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts, email.last_error), (OutgoingEmail.STATUS_PENDING, 1, 'boom'))
+            self.assertAlmostEqual(
+                (email.next_attempt_at - timezone.now()).total_seconds(), 60, delta=5
+            )
+            # 次の再送の時刻まではもう取り出さない
+            self.assertEqual(outbox.send_pending(), (0, 0))
+
+            OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+            self.assertEqual(outbox.send_pending(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.STATUS_FAILED, 2))
+        self.assertEqual(outbox.send_pending(), (0, 0))
+
+
+class PassBatonTests(TestCase):
+    """複数の宛先へのバトンパス（batons.pass_baton / views.pass_baton）"""
+
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create_user(username='sender', password='p')
+        self.v = User.objects.create_user(username='v', password='p')
+        self.w = User.objects.create_user(username='w', password='p')
+        UserProfile.objects.filter(user=self.v).update(email='v@example.com')
+        self.page = Page(image='x')
+        pages.add_page(self.page, Manga.objects.create(title='m', created_by=self.sender), self.sender)
+
+    def test_pass_to_several_users(self):
+        page = Page.objects.select_related('manga').get(pk=self.page.pk)
+        # 宛先の数によらず、ユーザー・バトン・メールのアドレス・メールの積み込みがそれぞれ1クエリ
+        # （と SAVEPOINT / RELEASE）
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(6):
+            results = batons.pass_baton(
+                page, self.sender, ['v', 'w', 'nobody', 'sender'], 'https://example.com/my-page/'
+            )
+
+        self.assertEqual(
+            [(result['username'], result['success']) for result in results],
+            [('v', True), ('w', True), ('nobody', False), ('sender', False)],
+        )
+        self.assertEqual(results[2]['error'], '指定されたユーザーが見つかりません')
+        self.assertEqual(results[3]['error'], '自分自身にはバトンを渡せません')
+        self.assertEqual(
+            set(Baton.objects.filter(page=self.page).values_list('to_user__username', flat=True)), {'v', 'w'}
+        )
+        # メールアドレスのある宛先にだけお知らせを積む
+        self.assertEqual(list(OutgoingEmail.objects.values_list('to_email', flat=True)), ['v@example.com'])
+        # 未達成バトン数はコミット後に数え直してある
+        with self.assertNumQueries(0):
+            self.assertEqual((batons.pending_count(self.v.id), batons.pending_count(self.w.id)), (1, 1))
+
+    def test_view(self):
+        self.client.force_login(self.sender)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f'/page/{self.page.id}/pass-baton/', {'to_user': 'v, w, nobody, sender'},
+                headers={'X-Requested-With': 'XMLHttpRequest'},
+            )
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['username'], 'v、w')
+        self.assertEqual([result['success'] for result in data['results']], [True, True, False, False])
+        self.assertEqual(batons.pending_count(self.v.id), 1)
+
+
+@override_settings(BATON_LIST_PAGE_SIZE=1)
+class MyBatonsTests(TestCase):
+    """マイページの受け取ったバトン（ページごとのまとめとキーセットページング）"""
+
+    def setUp(self):
+        self.a = User.objects.create_user(username='a', password='p')
+        self.b = User.objects.create_user(username='b', password='p')
+        self.receiver = User.objects.create_user(username='receiver', password='p')
+        manga = Manga.objects.create(title='m', created_by=self.a)
+        self.pages = []
+        for _ in range(3):
+            page = Page(image='x')
+            pages.add_page(page, manga, self.a)
+            self.pages.append(page)
+
+        now = timezone.now().replace(microsecond=0)
+        # pages[0] は a → b の順に2回。pages[1] と pages[2] は最後に受け取った時刻が同じ
+        self.pass_baton(self.pages[0], self.a, now - timedelta(hours=3))
+        self.pass_baton(self.pages[0], self.b, now - timedelta(hours=2))
+        self.pass_baton(self.pages[1], self.a, now)
+        self.pass_baton(self.pages[2], self.b, now)
+        # 達成済みのバトンは未達成の一覧に入らない
+        Baton.objects.create(page=self.pages[1], from_user=self.b, to_user=self.receiver, is_completed=True)
+        self.client.force_login(self.receiver)
+
+    def pass_baton(self, page, from_user, created_at):
+        baton = Baton.objects.create(page=page, from_user=from_user, to_user=self.receiver)
+        Baton.objects.filter(pk=baton.pk).update(created_at=created_at)
+
+    def test_groups_paged_by_latest_date(self):
+        received, cursor = [], None
+        for _ in range(4):
+            params = {'status': 'pending'}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.client.get('/my-page/batons/', params).json()
+            received.extend((baton['page_id'], baton['count'], baton['first_sender']) for baton in data['batons'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        # 同じ時刻のまとめはページIDの大きい順に、重複も抜けもなく1件ずつたどれる
+        self.assertEqual(received, [
+            (self.pages[2].id, 1, 'b'),
+            (self.pages[1].id, 1, 'a'),
+            (self.pages[0].id, 2, 'b'),
+        ])
+
+    def test_completed(self):
+        data = self.client.get('/my-page/batons/', {'status': 'completed'}).json()
+        self.assertEqual([(baton['page_id'], baton['count']) for baton in data['batons']], [(self.pages[1].id, 1)])
+        self.assertIsNone(data['next_cursor'])
+
+
+class PendingBatonCountTests(TestCase):
+    """ヘッダーの未達成バトン数（context_processors.pending_baton_count）"""
+
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create_user(username='sender', password='p')
+        self.receiver = User.objects.create_user(username='receiver', password='p')
+        self.manga = Manga.objects.create(title='m', created_by=self.sender)
+        self.page = Page(image='x')
+        pages.add_page(self.page, self.manga, self.sender)
+        self.client.force_login(self.receiver)
+
+    def render_count(self):
+        """マンガ一覧を表示して (バッジの数, Baton テーブルを読んだか) を返す"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/list/')
+        read_batons = any(Baton._meta.db_table in query['sql'] for query in queries.captured_queries)
+        return response.context['pending_baton_count'], read_batons
+
+    def test_cached_count_follows_pass_and_completion(self):
+        # 最初の表示だけ数える
+        self.assertEqual(self.render_count(), (0, True))
+        self.assertEqual(self.render_count(), (0, False))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            batons.pass_baton(self.page, self.sender, ['receiver'], 'https://example.com/my-page/')
+        self.assertEqual(self.render_count(), (1, False))
+
+        # 続きを描いてバトンを完了にすると、コミット後に数え直す
+        with self.captureOnCommitCallbacks(execute=True):
+            pages.add_page(Page(image='x'), self.manga, self.receiver, self.page)
+        self.assertEqual(self.render_count(), (0, False))
+
+
+@override_settings(MANGA_LIST_PAGE_SIZE=5)
+class MangaListTests(TestCase):
+    """マンガ一覧（views.manga_list / manga_list_json）のクエリ数とキーセットページング"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='p')
+        self.updated_at = timezone.now().replace(microsecond=0)
+
+    def add_mangas(self, count):
+        """count 作品を足す（2作品ずつ更新日時を同じにし、0〜2ページずつ描く）"""
+        for i in range(count):
+            manga = Manga.objects.create(title=f'm{i}', created_by=self.user)
+            for _ in range(i % 3):
+                pages.add_page(Page(image='x'), manga, self.user)
+            Manga.objects.filter(pk=manga.pk).update(updated_at=self.updated_at - timedelta(minutes=i // 2))
+
+    def test_query_count_does_not_grow(self):
+        for total in (3, 12):
+            with self.subTest(total=total):
+                self.add_mangas(total - Manga.objects.count())
+                with self.assertNumQueries(1):
+                    self.client.get('/list/')
+                with self.assertNumQueries(1):
+                    self.client.get('/list/json/')
+
+    def test_cursor_round_trip(self):
+        self.add_mangas(12)
+        expected = list(
+            Manga.objects.order_by('-updated_at', '-id')
+            .annotate(count=Count('pages')).values_list('id', 'count')
+        )
+
+        received, cursor = [], None
+        for _ in range(4):
+            data = self.client.get('/list/json/', {'cursor': cursor} if cursor else {}).json()
+            self.assertLessEqual(len(data['mangas']), 5)
+            received.extend((manga['id'], manga['page_count']) for manga in data['mangas'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(received, expected)
+
+        # 一覧の最初の1ページは HTML でも同じ順
+        response = self.client.get('/list/')
+        self.assertEqual([manga.id for manga in response.context['mangas']], [pk for pk, _ in expected[:5]])
+
+
+@override_settings(AI_REFERENCE_CACHE_BYTES=10)
+class ReferenceImageTests(SimpleTestCase):
+    """参照画像のプロセス内キャッシュ（ai.reference_image / _remember_reference）"""
+
+    def setUp(self):
+        for name, value in (('_references', OrderedDict()), ('_reference_bytes', 0)):
+            patcher = mock.patch.object(ai, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.http = mock.Mock()
+        self.http.get.side_effect = lambda url: mock.Mock(content=url.rsplit('/', 1)[-1].encode())
+        patcher = mock.patch.object(ai, '_get_http', return_value=self.http)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetched(self):
+        return [call.args[0] for call in self.http.get.call_args_list]
+
+    def test_cache_hit_skips_http(self):
+        self.assertEqual(ai.reference_image(1, 'https://example.com/v1/abcd'), b'abcd')
+        self.assertEqual(ai.reference_image(1, 'https://example.com/v1/abcd'), b'abcd')
+        self.assertEqual(self.fetched(), ['https://example.com/v1/abcd'])
+
+    def test_new_url_for_same_page_refetches(self):
+        ai.reference_image(1, 'https://example.com/v1/abcd')
+        # 画像を差し替えると URL のバージョンが変わる
+        self.assertEqual(ai.reference_image(1, 'https://example.com/v2/efgh'), b'efgh')
+        self.assertEqual(self.fetched(), ['https://example.com/v1/abcd', 'https://example.com/v2/efgh'])
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        ai.reference_image(1, 'https://example.com/v1/aaaa')
+        ai.reference_image(2, 'https://example.com/v1/bbbb')
+        ai.reference_image(1, 'https://example.com/v1/aaaa')  # 1 を最近使ったことにする
+        ai.reference_image(3, 'https://example.com/v1/cccc')  # 12 バイトになるので 2 を捨てる
+        self.assertEqual(list(ai._references), [
+            (1, 'https://example.com/v1/aaaa'), (3, 'https://example.com/v1/cccc'),
+        ])
+        self.assertEqual(ai._reference_bytes, 8)
+
+        # 上限より大きい画像は置かない
+        ai.reference_image(4, 'https://example.com/v1/dddddddddddd')
+        self.assertNotIn((4, 'https://example.com/v1/dddddddddddd'), ai._references)
+        self.assertEqual(ai._reference_bytes, 8)
+
+        ai.reference_image(2, 'https://example.com/v1/bbbb')
+        self.assertEqual(len(self.fetched()), 5)
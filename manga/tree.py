@@ -0,0 +1,572 @@
+"""
+マンガ1作品分のページツリーを1クエリで読み込み、
+深さ・優先度・おすすめ経路・ツリービュー用データを線形時間でまとめて計算する
+
+ツリー（MangaTree）はプロセスのメモリに置き（TREE_LOCAL_CACHE_PAGES ページまで）、
+共有キャッシュにはツリービュー用に組み立て済みの JSON だけを置く。
+
+- Manga.tree_version: ページ追加・削除・うぃーねで上がる。プロセスのツリーはこのバージョンで古さを判定する
+- Manga.structure_version: ページ追加・削除だけで上がる。ツリービュー用の JSON はうぃーね数を含まないので、
+  キーにはこちらを使い、うぃーねでは作り直さない
+
+うぃーねでバージョンが上がったときは、ツリーを読み込み直さずにうぃーね数だけを読み直して優先度を計算し直す
+（反映したプロセス自身は、反映した数をそのまま足す）。
+"""
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+from .models import Manga, Page
+
+_lock = threading.Lock()
+_trees = OrderedDict()  # manga_id -> MangaTree（使われていない順）
+_tree_pages = 0
+
+# ツリービューの間隔（vis.js の levelSeparation / nodeSpacing に相当）
+LEVEL_SEPARATION = 150
+NODE_SPACING = 120
+
+
+def display_title(page_id, title):
+    """Page.display_title と同じ規則のタイトル"""
+    return title or f"Page {page_id}"
+
+
+class MangaTree:
+    """
+    ページを位置（0..n-1）で参照する並列配列のツリー
+
+    ページは (depth, id) 順に読み込むので、親は必ず子より前に並ぶ。
+    同じ親の子は id 順になり、優先度が同じ場合は id の小さい子を選ぶ。
+    """
+
+    __slots__ = (
+        'manga_id', 'ids', 'index', 'parents', 'children', 'titles',
+        'authors', 'image_urls', 'thumbnail_urls', 'likes', 'depths',
+        'priorities', 'descendants', 'best_child', 'xs', 'ys',
+        'version', 'structure_version',
+    )
+
+    def __init__(self, manga_id, rows):
+        self.manga_id = manga_id
+        # 読み込んだときのマンガの tree_version / structure_version
+        self.version = 0
+        self.structure_version = 0
+        self.ids = []
+        self.index = {}
+        self.parents = []
+        self.children = []
+        self.titles = []
+        self.authors = []
+        self.image_urls = []
+        self.thumbnail_urls = []
+        self.likes = []
+
+        for row in rows:
+            self._append(*row)
+        self._compute()
+
+    def _append(self, page_id, parent_id, title, author, image, likes):
+        pos = len(self.ids)
+        self.ids.append(page_id)
+        self.index[page_id] = pos
+        parent = self.index.get(parent_id, -1) if parent_id is not None else -1
+        self.parents.append(parent)
+        self.children.append([])
+        if parent >= 0:
+            self.children[parent].append(pos)
+        self.titles.append(display_title(page_id, title))
+        self.authors.append(author)
+        self.image_urls.append(image.url if image else '')
+        self.thumbnail_urls.append(
+            image.build_url(width=100, height=100, crop='fill') if image else ''
+        )
+        self.likes.append(likes)
+
+    def _compute(self):
+        n = len(self.ids)
+
+        # 深さ：親が先に並んでいるので前から1回で決まる
+        self.depths = [0] * n
+        for pos in range(n):
+            parent = self.parents[pos]
+            if parent >= 0:
+                self.depths[pos] = self.depths[parent] + 1
+
+        self._compute_priorities()
+        self._layout()
+
+    def _compute_priorities(self):
+        """優先度（likes + 子孫の優先度）・子孫数・おすすめの子：後ろから1回で決まる"""
+        n = len(self.ids)
+        self.priorities = list(self.likes)
+        self.descendants = [0] * n
+        self.best_child = [-1] * n
+        for pos in range(n - 1, -1, -1):
+            parent = self.parents[pos]
+            if parent < 0:
+                continue
+            self.priorities[parent] += 1 + self.priorities[pos]
+            self.descendants[parent] += 1 + self.descendants[pos]
+            best = self.best_child[parent]
+            # 後ろから見ているので、同点なら id の小さい子で上書きする
+            if best < 0 or self.priorities[pos] >= self.priorities[best]:
+                self.best_child[parent] = pos
+
+    def _layout(self):
+        """
+        ツリービューの座標を決める（葉を左から順に1マスずつ並べ、親は最初と最後の子の中央に置く）
+        深さ優先の帰りがけ順で1回たどるだけなので線形時間
+        """
+        n = len(self.ids)
+        self.xs = [0] * n
+        self.ys = [self.depths[pos] * LEVEL_SEPARATION for pos in range(n)]
+
+        next_slot = 0
+        for root in range(n):
+            if self.parents[root] >= 0:
+                continue
+            # (位置, 子を積み終えたか) のスタックで再帰を使わずにたどる
+            stack = [(root, False)]
+            while stack:
+                pos, expanded = stack.pop()
+                children = self.children[pos]
+                if not children:
+                    self.xs[pos] = next_slot * NODE_SPACING
+                    next_slot += 1
+                elif expanded:
+                    self.xs[pos] = (self.xs[children[0]] + self.xs[children[-1]]) // 2
+                else:
+                    stack.append((pos, True))
+                    for child in reversed(children):
+                        stack.append((child, False))
+
+    def copy(self):
+        """
+        配列を複製したツリー（ほかのリクエストが読んでいるツリーを書き換えずに、複製のほうを更新する）
+        子のリストは中身を共有するので、書き換えるときはそのリストだけ作り直す
+        """
+        tree = MangaTree.__new__(MangaTree)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            setattr(tree, name, value.copy() if isinstance(value, (list, dict)) else value)
+        return tree
+
+    def add_likes(self, page_id, count):
+        """
+        反映したうぃーね数をページと祖先の優先度に足す（copy() した複製に対して呼ぶ）
+        優先度が上がるのは経路上のページだけなので、おすすめの子は経路上の子に替わるかだけを見る
+        """
+        pos = self.index.get(page_id)
+        if pos is None:
+            return
+        self.likes[pos] += count
+        self.priorities[pos] += count
+        child = pos
+        parent = self.parents[pos]
+        while parent >= 0:
+            self.priorities[parent] += count
+            best = self.best_child[parent]
+            if (self.priorities[child], -self.ids[child]) > (self.priorities[best], -self.ids[best]):
+                self.best_child[parent] = child
+            child = parent
+            parent = self.parents[parent]
+
+    def reload_likes(self):
+        """
+        うぃーね数だけを1クエリで読み直して優先度を計算し直す（copy() した複製に対して呼ぶ）
+        ページの構成が同じなら、画像の URL や座標を作り直さずに済む
+        読んでいる間にページが追加・削除されていたら何もせずに False を返す
+        """
+        rows = list(
+            Page.objects.filter(manga_id=self.manga_id)
+            .values_list('id', 'likes', 'manga__tree_version', 'manga__structure_version')
+        )
+        if not rows or rows[0][3] != self.structure_version:
+            return False
+        likes = {page_id: page_likes for page_id, page_likes, _, _ in rows}
+        self.likes = [likes.get(page_id, 0) for page_id in self.ids]
+        self._compute_priorities()
+        self.version = rows[0][2]
+        return True
+
+    def add_page(self, page):
+        """
+        新しく追加されたページをキャッシュ済みのツリーに足す（DBを読まずに済む）
+        ページは末尾に追加されるが、親が子より前に並ぶ条件は保たれる
+        全体を計算し直さず、祖先の経路だけを更新して、後ろの葉の座標を1マスずらす
+        copy() した複製に対して呼ぶ（配列をその場で書き換える）
+        """
+        if page.pk in self.index:
+            return
+        parent = self.index.get(page.parent_id, -1)
+        if parent >= 0:
+            # 複製元と共有している子のリストは書き換えない
+            self.children[parent] = list(self.children[parent])
+        image = Page._meta.get_field('image').to_python(page.image)
+        self._append(page.pk, page.parent_id, page.title, page.author.username, image, page.likes)
+
+        pos = len(self.ids) - 1
+        parent = self.parents[pos]
+        self.depths.append(self.depths[parent] + 1 if parent >= 0 else 0)
+        self.priorities.append(page.likes)
+        self.descendants.append(0)
+        self.best_child.append(-1)
+        self.ys.append(self.depths[pos] * LEVEL_SEPARATION)
+
+        # 優先度・子孫数・おすすめの子：変わるのは祖先だけ
+        child = pos
+        while parent >= 0:
+            self.priorities[parent] += 1 + page.likes
+            self.descendants[parent] += 1
+            best = self.best_child[parent]
+            if best < 0 or (self.priorities[child], -self.ids[child]) > (self.priorities[best], -self.ids[best]):
+                self.best_child[parent] = child
+            child = parent
+            parent = self.parents[parent]
+
+        self._layout_added(pos)
+
+    def _layout_added(self, pos):
+        """
+        末尾に追加した葉 pos の座標を決める（_layout と同じ配置になる）
+        新しい葉は親の部分木の右端の葉の次のマスに入るので、そのマスより右のページを1マスずらし、
+        祖先だけを子の中央に置き直す
+        """
+        parent = self.parents[pos]
+        if parent < 0:
+            # 新しいルート：いちばん右の葉の次のマス
+            self.xs.append(max(self.xs[:pos], default=-NODE_SPACING) + NODE_SPACING)
+            return
+        if len(self.children[parent]) == 1:
+            # 葉だった親の真下に入るだけなので、ほかのページは動かない
+            self.xs.append(self.xs[parent])
+            return
+
+        # 親の部分木の右端の葉（新しいページは除く）の次のマス
+        rightmost = self.children[parent][-2]
+        while self.children[rightmost]:
+            rightmost = self.children[rightmost][-1]
+        x = self.xs[rightmost] + NODE_SPACING
+
+        ancestors = set()
+        current = parent
+        while current >= 0:
+            ancestors.add(current)
+            current = self.parents[current]
+
+        # 祖先以外のページは部分木がそのマスより左か右のどちらかにあるので、右にあるものだけずらす
+        for other in range(pos):
+            if self.xs[other] >= x and other not in ancestors:
+                self.xs[other] += NODE_SPACING
+        self.xs.append(x)
+
+        current = parent
+        while current >= 0:
+            children = self.children[current]
+            self.xs[current] = (self.xs[children[0]] + self.xs[children[-1]]) // 2
+            current = self.parents[current]
+
+    @classmethod
+    def load(cls, manga_id):
+        """マンガのページをすべて1クエリで読み込む"""
+        rows = list(
+            Page.objects.filter(manga_id=manga_id)
+            .order_by('depth', 'id')
+            .values_list(
+                'id', 'parent_id', 'title', 'author__username', 'image', 'likes',
+                'manga__tree_version', 'manga__structure_version',
+            )
+        )
+        tree = cls(manga_id, (row[:6] for row in rows))
+        if rows:
+            # ページと同じクエリで読んだバージョン（読み込み中に上がっても、読んだ内容と食い違わない）
+            tree.version, tree.structure_version = rows[0][6:]
+        return tree
+
+    def payload(self):
+        """ツリービュー用の (ページ数, nodes の JSON, edges の JSON)"""
+        return len(self.ids), json.dumps(self.vis_nodes()), json.dumps(self.vis_edges())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, page_id):
+        return page_id in self.index
+
+    def reading_path(self, page_id):
+        """ルート → page → 優先度の高い子をたどった末端までの位置リスト"""
+        pos = self.index[page_id]
+
+        path = []
+        current = pos
+        while current >= 0:
+            path.append(current)
+            current = self.parents[current]
+        path.reverse()
+
+        current = self.best_child[pos]
+        while current >= 0:
+            path.append(current)
+            current = self.best_child[current]
+        return path
+
+    def best_path(self, page_id, length):
+        """page から優先度の高い子をたどった、最大 length ページ分のID"""
+        path = [page_id]
+        current = self.best_child[self.index[page_id]]
+        while current >= 0 and len(path) < length:
+            path.append(self.ids[current])
+            current = self.best_child[current]
+        return path
+
+    def branches(self, page_id):
+        """ページの子（分岐）一覧"""
+        return [
+            {
+                "id": self.ids[child],
+                "title": self.titles[child],
+                "author": self.authors[child],
+                "priority": self.priorities[child],
+            }
+            for child in self.children[self.index[page_id]]
+        ]
+
+    def page_data(self, pos):
+        """ビューア用のページ情報"""
+        page_id = self.ids[pos]
+        return {
+            "id": page_id,
+            "title": self.titles[pos],
+            "image": self.image_urls[pos],
+            "likes": self.likes[pos],
+            "like_url": f"/page/{page_id}/like/",
+            "author": self.authors[pos],
+            "children": self.branches(page_id),
+        }
+
+    def vis_node(self, pos):
+        """vis.js 用のノード"""
+        return {
+            "id": self.ids[pos],
+            "title": self.titles[pos],
+            "author": self.authors[pos],
+            "imageUrl": self.thumbnail_urls[pos],
+            "level": self.depths[pos],
+            "x": self.xs[pos],
+            "y": self.ys[pos],
+        }
+
+    def vis_nodes(self):
+        """vis.js 用のノード一覧"""
+        return [self.vis_node(pos) for pos in range(len(self.ids))]
+
+    def vis_edges(self):
+        """vis.js 用のエッジ一覧"""
+        return [
+            {"from": self.ids[parent], "to": self.ids[pos]}
+            for pos, parent in enumerate(self.parents)
+            if parent >= 0
+        ]
+
+    def _collect_subtree(self, pos, levels, included):
+        """pos から levels 段下までの位置を included に加える（幅優先）"""
+        frontier = [pos]
+        included.add(pos)
+        for _ in range(levels):
+            next_frontier = []
+            for current in frontier:
+                next_frontier.extend(self.children[current])
+            included.update(next_frontier)
+            frontier = next_frontier
+            if not frontier:
+                break
+
+    def _slice_payload(self, included):
+        """
+        含めるページのノード・エッジに加えて、
+        隠れた子を持つページには隠れているページ数を表す折りたたみノードを付ける
+        """
+        nodes = []
+        edges = []
+        for pos in sorted(included):
+            page_id = self.ids[pos]
+            nodes.append(self.vis_node(pos))
+
+            parent = self.parents[pos]
+            if parent in included:
+                edges.append({"from": self.ids[parent], "to": page_id})
+
+            hidden = sum(
+                1 + self.descendants[child]
+                for child in self.children[pos]
+                if child not in included
+            )
+            if hidden:
+                stub_id = f"more-{page_id}"
+                nodes.append({
+                    "id": stub_id,
+                    "stub": True,
+                    "parent": page_id,
+                    "hidden": hidden,
+                    "level": self.depths[pos] + 1,
+                    "x": self.xs[pos],
+                    "y": self.ys[pos] + LEVEL_SEPARATION,
+                })
+                edges.append({"from": page_id, "to": stub_id})
+        return {"nodes": nodes, "edges": edges}
+
+    def window(self, page_id, levels):
+        """page の上下 levels 段だけを含むツリービュー用データ"""
+        pos = self.index[page_id]
+        included = set()
+
+        current = self.parents[pos]
+        for _ in range(levels):
+            if current < 0:
+                break
+            included.add(current)
+            current = self.parents[current]
+
+        self._collect_subtree(pos, levels, included)
+        return self._slice_payload(included)
+
+    def subtree_slice(self, page_id, levels):
+        """折りたたみノードを展開したときに返す、page から levels 段下までのデータ"""
+        included = set()
+        self._collect_subtree(self.index[page_id], levels, included)
+        return self._slice_payload(included)
+
+
+def payload_cache_key(manga_id, structure_version):
+    return f"manga-tree-payload:{manga_id}:s{structure_version}"
+
+
+def _remember_tree(tree):
+    """
+    マンガのツリーを新しいバージョンに入れ替える
+    TREE_LOCAL_CACHE_PAGES ページを超えたら、使われていない順に捨てる
+    """
+    global _tree_pages
+    with _lock:
+        current = _trees.get(tree.manga_id)
+        if current is not None:
+            if current.version >= tree.version:
+                return
+            _tree_pages -= len(current)
+        _trees[tree.manga_id] = tree
+        _trees.move_to_end(tree.manga_id)
+        _tree_pages += len(tree)
+        while _tree_pages > settings.TREE_LOCAL_CACHE_PAGES and len(_trees) > 1:
+            _, evicted = _trees.popitem(last=False)
+            _tree_pages -= len(evicted)
+
+
+def get_tree(manga):
+    """
+    ツリーをプロセスのメモリから取得する（なければ1クエリで読み込む）
+    大きなツリーを共有キャッシュから毎回取り出して復元するより、プロセスに置いておくほうが速い
+    うぃーねでバージョンが上がっただけなら、うぃーね数だけを読み直した複製を使う
+    """
+    with _lock:
+        cached = _trees.get(manga.id)
+        if cached is not None:
+            _trees.move_to_end(manga.id)
+    if cached is not None and cached.version >= manga.tree_version:
+        return cached
+
+    tree = None
+    if cached is not None and cached.structure_version == manga.structure_version:
+        tree = cached.copy()
+        if not tree.reload_likes():
+            tree = None
+    if tree is None:
+        tree = MangaTree.load(manga.id)
+    # ページがなければクエリからバージョンを読めないので、manga のものを使う
+    tree.version = max(tree.version, manga.tree_version)
+    tree.structure_version = max(tree.structure_version, manga.structure_version)
+    _remember_tree(tree)
+    return tree
+
+
+def get_tree_payload(manga):
+    """
+    ツリービュー用の (ページ数, nodes の JSON, edges の JSON)
+    組み立て済みの文字列を共有キャッシュに置くので、キャッシュにあればツリーを使わずにそのまま返す
+    """
+    key = payload_cache_key(manga.id, manga.structure_version)
+    payload = cache.get(key)
+    if payload is None:
+        payload = get_tree(manga).payload()
+        cache.set(key, payload, settings.TREE_CACHE_TIMEOUT)
+    return payload
+
+
+def _previous_tree(manga_id, version):
+    """このプロセスにバージョン version の1つ前のツリーがあれば返す"""
+    with _lock:
+        previous = _trees.get(manga_id)
+    if previous is None or previous.version != version - 1:
+        return None
+    return previous
+
+
+def extend_cached_tree(page, version):
+    """
+    ページ追加でバージョンが version に上がったとき、
+    このプロセスに1つ前のバージョンのツリーがあれば、複製にページを足して引き継ぐ
+    （ほかのリクエストが読んでいる途中の古いツリーは書き換えない。
+    ツリービュー用の JSON は、次に使われたときに組み立てる）
+    """
+    previous = _previous_tree(page.manga_id, version)
+    if previous is None:
+        return
+    tree = previous.copy()
+    tree.add_page(page)
+    tree.version = version
+    tree.structure_version = previous.structure_version + 1  # 同じ UPDATE で上がっている
+    _remember_tree(tree)
+
+
+def apply_cached_likes(manga_id, version, counts):
+    """
+    うぃーねの反映でバージョンが version に上がったとき、
+    このプロセスに1つ前のバージョンのツリーがあれば、複製に反映した数 {ページID: 数} を足して引き継ぐ
+    """
+    previous = _previous_tree(manga_id, version)
+    if previous is None:
+        return
+    tree = previous.copy()
+    for page_id, count in counts.items():
+        tree.add_likes(page_id, count)
+    tree.version = version
+    _remember_tree(tree)
+
+
+def bump_tree_version(manga_id, touch=False, structure=True):
+    """
+    マンガのツリーのバージョンを上げて、キャッシュ済みのツリーを無効にする
+    structure=True（ページの追加・削除）なら structure_version も上げる。うぃーねだけなら False
+    touch=True なら updated_at も同じ UPDATE で更新する。上がった後の tree_version を返す
+    """
+    assignments = "tree_version = tree_version + 1"
+    if structure:
+        assignments += ", structure_version = structure_version + 1"
+    params = []
+    if touch:
+        assignments += ", updated_at = %s"
+        params.append(connection.ops.adapt_datetimefield_value(timezone.now()))
+    params.append(manga_id)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {Manga._meta.db_table} SET {assignments} WHERE id = %s RETURNING tree_version",
+            params,
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
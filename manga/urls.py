@@ -5,6 +5,7 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('new/', views.create_manga, name='create_manga'),
     path('list/', views.manga_list, name='manga_list'),
+    path('list/json/', views.manga_list_json, name='manga_list_json'),
     path('<int:manga_id>/', views.manga_detail, name='manga_detail'),
     path('<int:manga_id>/create/', views.create_page, name='create_page'),
     path('<int:manga_id>/editor/', views.manga_editor, name='manga_editor'),
@@ -13,11 +14,17 @@ urlpatterns = [
     path('page/<int:page_id>/like/', views.like_page, name='like_page'),
     path("page/<int:page_id>/viewer/", views.page_viewer, name="page_viewer"),
     path("page/<int:page_id>/branches/", views.page_branches_json, name="page_branches_json"),
+    path("page/<int:page_id>/subtree/", views.page_subtree_json, name="page_subtree_json"),
+    path("pages/branches/", views.page_branches_batch_json, name="page_branches_batch_json"),
     
     # バトンパス機能
     path('page/<int:page_id>/pass-baton/', views.pass_baton, name='pass_baton'),
     path('my-page/', views.my_page, name='my_page'),
+    path('my-page/pages/', views.my_pages_json, name='my_pages_json'),
+    path('my-page/batons/', views.my_batons_json, name='my_batons_json'),
 
         # AI画像生成
     path('page/<int:parent_id>/generate-ai/', views.generate_page_with_ai, name='generate_page_with_ai'),
+    path('ai-jobs/<int:job_id>/', views.ai_job_status, name='ai_job_status'),
+    path('ai-jobs/<int:job_id>/events/', views.ai_job_events, name='ai_job_events'),
 ]
\ No newline at end of file
@@ -1,14 +1,22 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from django.core.handlers.asgi import ASGIRequest
+from django.urls import reverse
+from django.utils import timezone
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import LoginView
 from django.contrib.auth import login
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST
 from django.contrib import messages
-from django.core.mail import send_mail
 from django.conf import settings
-from .models import Manga, Page, Baton, UserProfile
+from .models import Manga, Page, Baton, UserProfile, AIGenerationJob
 from .forms import MangaForm, PageForm, SignupWithEmailForm, UserProfileForm, BatonPassForm, UsernameChangeForm
+from .tree import get_tree, get_tree_payload
+from . import admission, ai, batons, likes, pages
+from .pagination import paginate_keyset
 import json
 
 
@@ -30,149 +38,118 @@ def create_manga(request):
     return render(request, 'manga/create_manga.html', {'form': form})
 
 
+def _manga_list_page(request):
+    """
+    更新日時の新しい順に1ページ分のマンガを取得（ページ数・作成者も同じクエリで）
+    ページ数は JOIN して GROUP BY すると全件を集計してから並べ替えることになるので、
+    manga_updated_idx で1ページ分を取ってから、その行の分だけサブクエリで数える
+    """
+    page_count = (
+        Page.objects.filter(manga=OuterRef('pk'))
+        .order_by()
+        .values('manga')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    mangas = Manga.objects.select_related('created_by').annotate(
+        page_count=Coalesce(Subquery(page_count), 0)
+    )
+    return paginate_keyset(
+        mangas, request.GET.get('cursor'), settings.MANGA_LIST_PAGE_SIZE, 'updated_at'
+    )
+
+
 def manga_list(request):
-    mangas = Manga.objects.all().order_by('-updated_at')
-    return render(request, 'manga/manga_list.html', {'mangas': mangas})
+    mangas, next_cursor = _manga_list_page(request)
+    return render(request, 'manga/manga_list.html', {
+        'mangas': mangas,
+        'next_cursor': next_cursor,
+    })
+
+
+def manga_list_json(request):
+    """無限スクロール用のマンガ一覧"""
+    mangas, next_cursor = _manga_list_page(request)
+    data = [
+        {
+            "id": manga.id,
+            "title": manga.title,
+            "url": reverse('manga_detail', args=[manga.id]),
+            "cover_image": manga.cover_image.url if manga.cover_image else None,
+            "created_by": manga.created_by.username if manga.created_by else None,
+            "page_count": manga.page_count,
+            "updated_at": timezone.localtime(manga.updated_at).strftime('%Y/%m/%d %H:%M'),
+        }
+        for manga in mangas
+    ]
+    return JsonResponse({"mangas": data, "next_cursor": next_cursor})
 
 
 def manga_detail(request, manga_id):
     manga = get_object_or_404(Manga, id=manga_id)
-    pages = list(manga.pages.select_related('author', 'parent'))
-
-    def get_depth(page):
-        depth = 0
-        p = page.parent
-        while p:
-            depth += 1
-            p = p.parent
-        return depth
-
-    nodes = []
-    edges = []
-    for page in pages:
-        thumbnail_url = page.image.build_url(width=100, height=100, crop='fill') if page.image else ''
-        
-        nodes.append({
-            "id": page.id,
-            "title": page.display_title,
-            "author": page.author.username,
-            "imageUrl": thumbnail_url,
-            "level": get_depth(page),
-        })
-
-        if page.parent_id:
-            edges.append({"from": page.parent_id, "to": page.id})
+    page_count, nodes_json, edges_json = get_tree_payload(manga)
 
     return render(request, 'manga/manga_detail.html', {
         'manga': manga,
-        'nodes': json.dumps(nodes),
-        'edges': json.dumps(edges),
+        'page_count': page_count,
+        'nodes': nodes_json,
+        'edges': edges_json,
     })
 
 
 def page_viewer(request, page_id):
     """クリックしたページから、親→子（優先度順）までのリストを構築してビューアに渡す"""
-    page = get_object_or_404(Page, id=page_id)
-
-    # 1. 親ページをすべて再帰的に遡る
-    ancestors = []
-    current = page.parent
-    while current:
-        ancestors.insert(0, current)
-        current = current.parent
-
-    # 2. 優先度の高い子を再帰的にたどる
-    descendants = []
-    def traverse_best_child(p):
-        children = list(p.children.all())
-        if not children:
-            return
-        best_child = max(children, key=lambda c: c.get_priority())
-        descendants.append(best_child)
-        traverse_best_child(best_child)
-
-    traverse_best_child(page)
-
-    # 3. リストを統合
-    ordered_pages = ancestors + [page] + descendants
-
-    # 4. JSON用データ
-    pages_data = []
-    for p in ordered_pages:
-        children_data = [
-            {
-                "id": c.id,
-                "title": c.display_title,
-                "author": c.author.username,
-                "priority": c.get_priority(),
-            }
-            for c in p.children.all()
-        ]
-
-        pages_data.append({
-            "id": p.id,
-            "title": p.display_title,
-            "image": p.image.url,
-            "likes": p.likes,
-            "like_url": f"/page/{p.id}/like/",
-            "author": p.author.username,
-            "children": children_data,
-        })
-
-    current_index = ordered_pages.index(page)
-
-    # 5. ツリービュー用データ
+    page = get_object_or_404(Page.objects.select_related('manga', 'author'), id=page_id)
     manga = page.manga
-    all_pages = list(manga.pages.select_related('author', 'parent'))
-
-    def get_depth(p):
-        depth = 0
-        parent = p.parent
-        while parent:
-            depth += 1
-            parent = parent.parent
-        return depth
-
-    nodes = []
-    edges = []
-    for p in all_pages:
-        thumbnail_url = p.image.build_url(width=100, height=100, crop='fill') if p.image else ''
-        
-        nodes.append({
-            "id": p.id,
-            "title": p.display_title,
-            "author": p.author.username,
-            "imageUrl": thumbnail_url,
-            "level": get_depth(p),
-        })
-
-        if p.parent_id:
-            edges.append({"from": p.parent_id, "to": p.id})
-
-    # 6. OGP用の絶対URL画像を取得
+
+    # 1. マンガ全体のツリーを取得（キャッシュがなければ1クエリで読み込む）
+    tree = get_tree(manga)
+
+    # 2. 親ページ → 現在ページ → 優先度の高い子の順に並べる
+    ordered = tree.reading_path(page.id)
+    current_index = ordered.index(tree.index[page.id])
+
+    # 3. JSON用データ（まだDBに反映されていないうぃーねと、うぃーね済みかどうかも付ける）
+    pages_data = [tree.page_data(pos) for pos in ordered]
+    pending_likes, liked = likes.path_state(
+        likes.get_viewer(request), [data["id"] for data in pages_data]
+    )
+    for data in pages_data:
+        data["likes"] += pending_likes.get(data["id"], 0)
+        data["liked"] = data["id"] in liked
+
+    # 4. OGP用の絶対URL画像を取得
     page_image_url = page.image.url
     if not page_image_url.startswith('http'):
         # 相対URLの場合は絶対URLに変換
         page_image_url = request.build_absolute_uri(page_image_url)
     
-    # 7. 表紙画像も絶対URLに変換
+    # 5. 表紙画像も絶対URLに変換
     cover_image_url = None
     if manga.cover_image:
         cover_image_url = manga.cover_image.url
         if not cover_image_url.startswith('http'):
             cover_image_url = request.build_absolute_uri(cover_image_url)
 
-    # 8. 現在のページの絶対URLを取得
+    # 6. 現在のページの絶対URLを取得
     absolute_url = request.build_absolute_uri()
 
+    # 7. ツリービュー用データ（巨大なマンガは現在ページの周辺だけ送る）
+    if len(tree) > settings.TREE_WINDOW_THRESHOLD:
+        window = tree.window(page.id, settings.TREE_WINDOW_LEVELS)
+        nodes_json = json.dumps(window["nodes"])
+        edges_json = json.dumps(window["edges"])
+    else:
+        _, nodes_json, edges_json = get_tree_payload(manga)
+
     return render(request, "manga/viewer.html", {
         "manga": manga,
-        "pages": ordered_pages,
+        "pages": pages_data,
         "pages_json": json.dumps(pages_data),
         "current_index": current_index,
         "first_page": page,
-        "nodes": json.dumps(nodes),
-        "edges": json.dumps(edges),
+        "nodes": nodes_json,
+        "edges": edges_json,
         "current_page_id": page.id,
         "page_image_url": page_image_url,  # OGP用の絶対URL画像
         "cover_image_url": cover_image_url,  # 背景用の絶対URL画像
@@ -181,19 +158,65 @@ def page_viewer(request, page_id):
 
 
 def page_branches_json(request, page_id):
-    page = get_object_or_404(Page, id=page_id)
-    children = page.children.all()
+    page = get_object_or_404(Page.objects.select_related('manga'), id=page_id)
+    tree = get_tree(page.manga)
+    return JsonResponse({"branches": tree.branches(page.id)})
 
-    data = [
-        {
-            "id": child.id,
-            "title": child.display_title,
-            "author": child.author.username,
-            "priority": child.get_priority(),
-        }
-        for child in children
-    ]
-    return JsonResponse({"branches": data})
+
+def page_subtree_json(request, page_id):
+    """ツリービューの折りたたみノードを展開したときの部分ツリー"""
+    page = get_object_or_404(Page.objects.select_related('manga'), id=page_id)
+    tree = get_tree(page.manga)
+
+    try:
+        levels = int(request.GET.get('levels', settings.TREE_WINDOW_LEVELS))
+    except ValueError:
+        levels = settings.TREE_WINDOW_LEVELS
+    levels = max(1, min(levels, settings.TREE_WINDOW_LEVELS))
+
+    return JsonResponse(tree.subtree_slice(page.id, levels))
+
+
+# 分岐の一括取得で一度に扱えるページ数・段数の上限
+BRANCHES_BATCH_MAX_IDS = 50
+BRANCHES_BATCH_MAX_DEPTH = 20
+
+
+def page_branches_batch_json(request):
+    """
+    複数ページの分岐をまとめて返す（ビューアの先読み用）
+    ?ids=1,2,3 で指定したページ、または ?start=1&depth=5 で start から
+    優先度の高い子を depth 段たどった各ページの分岐を、ビューアと同じキャッシュ済みのツリーから返す
+    ids は1つのマンガのページに限る（1回のリクエストで読み込むツリーを1つにするため）
+    """
+    if 'start' in request.GET:
+        try:
+            start_id = int(request.GET['start'])
+            depth = int(request.GET.get('depth', 5))
+        except ValueError:
+            return JsonResponse({'error': 'start と depth は整数で指定してください'}, status=400)
+        depth = max(1, min(depth, BRANCHES_BATCH_MAX_DEPTH))
+
+        start = get_object_or_404(Page.objects.select_related('manga').only('id', 'manga'), id=start_id)
+        tree = get_tree(start.manga)
+        page_ids = tree.best_path(start.id, depth)
+        trees = [tree]
+    else:
+        try:
+            page_ids = [int(pk) for pk in request.GET.get('ids', '').split(',') if pk.strip()]
+        except ValueError:
+            return JsonResponse({'error': 'ids はカンマ区切りの整数で指定してください'}, status=400)
+        page_ids = page_ids[:BRANCHES_BATCH_MAX_IDS]
+        mangas = list(Manga.objects.filter(pages__id__in=page_ids).distinct()[:2])
+        if len(mangas) > 1:
+            return JsonResponse({'error': 'ids は同じマンガのページで指定してください'}, status=400)
+        trees = [get_tree(manga) for manga in mangas]
+
+    branches = {}
+    for page_id in page_ids:
+        tree = next((tree for tree in trees if page_id in tree), None)
+        branches[str(page_id)] = tree.branches(page_id) if tree is not None else []
+    return JsonResponse({"pages": page_ids, "branches": branches})
 
 
 @login_required
@@ -213,12 +236,7 @@ def create_page(request, manga_id, parent_id=None):
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             if form.is_valid():
                 # ページを保存
-                page = form.save(commit=False)
-                page.manga = manga
-                page.author = request.user
-                if parent:
-                    page.parent = parent
-                page.save()
+                pages.add_page(form.save(commit=False), manga, request.user, parent)
                 
                 return JsonResponse({
                     'success': True,
@@ -233,12 +251,7 @@ def create_page(request, manga_id, parent_id=None):
         
         # 通常のPOSTリクエスト（フォールバック）
         if form.is_valid():
-            page = form.save(commit=False)
-            page.manga = manga
-            page.author = request.user
-            if parent:
-                page.parent = parent
-            page.save()
+            pages.add_page(form.save(commit=False), manga, request.user, parent)
             return redirect('manga_detail', manga_id=manga.id)
     else:
         form = PageForm()
@@ -252,40 +265,36 @@ def create_page(request, manga_id, parent_id=None):
 
 @login_required
 def continue_page(request, parent_id):
-    parent = get_object_or_404(Page, id=parent_id)
+    parent = get_object_or_404(Page.objects.select_related('manga'), id=parent_id)
     manga = parent.manga
 
     if request.method == 'POST':
         form = PageForm(request.POST, request.FILES)
+        draft_id = request.POST.get('draft_id', '')
+        if draft_id:
+            # AI生成の下書きを使う場合は画像をアップロードしない
+            form.fields['image'].required = False
         
         # AJAX リクエストの場合
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             if form.is_valid():
-                # ページ保存前にバトンをチェック（signalで自動完了される前に）
-                completed_batons = Baton.objects.filter(
-                    page=parent,
-                    to_user=request.user,
-                    is_completed=False
-                )
-                
-                print(f"DEBUG: Checking batons for parent page {parent.id}, user {request.user.username}")
-                print(f"DEBUG: Found {completed_batons.count()} uncompleted batons")
+                # ページを保存し、親ページへの自分宛てのバトンを同じトランザクションで完了にする
+                try:
+                    completed = pages.add_page(
+                        form.save(commit=False), manga, request.user, parent, draft_id
+                    )
+                except pages.DraftUnavailable:
+                    return JsonResponse({
+                        'success': False,
+                        'error': 'AI生成画像が見つかりません。もう一度生成してください'
+                    })
                 
                 baton_completed = None
-                if completed_batons.exists():
-                    count = completed_batons.count()
+                if completed:
                     baton_completed = {
-                        'count': count,
+                        'count': completed,
                         'page_id': parent.id  # 親ページのID
                     }
-                    print(f"DEBUG: Baton completed: {baton_completed}")
-                
-                # ページを保存（この時点でsignalが発火してバトンが完了になる）
-                page = form.save(commit=False)
-                page.manga = manga
-                page.author = request.user
-                page.parent = parent
-                page.save()
                 
                 return JsonResponse({
                     'success': True,
@@ -300,12 +309,12 @@ def continue_page(request, parent_id):
         
         # 通常のPOSTリクエスト（フォールバック）
         if form.is_valid():
-            page = form.save(commit=False)
-            page.manga = manga
-            page.author = request.user
-            page.parent = parent
-            page.save()
-            return redirect('manga_detail', manga_id=manga.id)
+            try:
+                pages.add_page(form.save(commit=False), manga, request.user, parent, draft_id)
+            except pages.DraftUnavailable:
+                messages.error(request, 'AI生成画像が見つかりません。もう一度生成してください')
+            else:
+                return redirect('manga_detail', manga_id=manga.id)
     else:
         form = PageForm()
 
@@ -338,10 +347,11 @@ def page_list(request):
 @require_POST
 def like_page(request, page_id):
     """ページに1うぃーね追加"""
-    page = get_object_or_404(Page, id=page_id)
-    page.likes += 1
-    page.save(update_fields=["likes"])
-    return JsonResponse({"likes": page.likes})
+    page = get_object_or_404(Page.objects.only('id', 'likes'), id=page_id)
+    viewer = likes.get_viewer(request, create_session=True)
+    # DBへの反映は likes.flush() がまとめて行う
+    count, counted = likes.add_like(page, viewer)
+    return JsonResponse({"likes": count, "liked": True, "counted": counted})
 
 
 # ========== バトンパス機能 ==========
@@ -349,174 +359,106 @@ def like_page(request, page_id):
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
-from django.core.mail import send_mail
 from django.conf import settings
 from .models import Page, Baton
 from .forms import BatonPassForm
 
 @login_required
-def pass_baton(request, page_id):
-    """バトンパス処理"""
-    page = get_object_or_404(Page, id=page_id)
+async def pass_baton(request, page_id):
+    """
+    バトンパス処理（カンマ区切りで複数のユーザーにまとめて渡せる）
+    お知らせメールはアウトボックスに積むだけで、送信は send_emails コマンドが行う
+    """
+    page = await aget_object_or_404(Page.objects.select_related('manga', 'author'), id=page_id)
+    user = await request.auser()
     
     if request.method == 'POST':
         form = BatonPassForm(request.POST)
+        results = []
+        if form.is_valid():
+            # 宛先ごとの結果（見つからない・自分自身なら失敗）
+            results = await sync_to_async(batons.pass_baton)(
+                page, user, form.cleaned_data['to_user'],
+                request.build_absolute_uri('/my-page/'),
+            )
+        passed = [result['username'] for result in results if result['success']]
+        failed = [result for result in results if not result['success']]
         
         # AJAX リクエストの場合
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            if form.is_valid():
-                to_user = form.cleaned_data['to_user']
-                
-                # 自分自身には送れない
-                if to_user == request.user:
-                    return JsonResponse({
-                        'success': False,
-                        'error': '自分自身にはバトンを渡せません'
-                    })
-                
-                # バトン作成
-                baton = Baton.objects.create(
-                    page=page,
-                    from_user=request.user,
-                    to_user=to_user
-                )
-                
-                # メール通知
-                email_sent = False
-                try:
-                    if hasattr(to_user, 'profile') and to_user.profile.email:
-                        print(f"DEBUG: Attempting to send email to {to_user.profile.email}")
-                        
-                        # マイページURLを生成
-                        my_page_url = request.build_absolute_uri('/my-page/')
-                        
-                        send_mail(
-                            subject=f'【リレーマンガ】{request.user.username}さんからバトンが届きました',
-                            message=f'{request.user.username}さんから「{page.manga.title}」のバトンが届きました。\n\n'
-                                    f'ページ: {page.display_title}\n\n'
-                                    f'マイページから確認してください：\n'
-                                    f'{my_page_url}\n\n'
-                                    f'続きを描いてみませんか？',
-                            from_email=settings.DEFAULT_FROM_EMAIL,
-                            recipient_list=[to_user.profile.email],
-                            fail_silently=False,  # エラーを表示
-                        )
-                        email_sent = True
-                        print(f"DEBUG: Email sent successfully to {to_user.profile.email}")
-                    else:
-                        print(f"DEBUG: User {to_user.username} has no email address registered")
-                except Exception as e:
-                    print(f"DEBUG: Email sending failed: {str(e)}")
-                    # メール送信失敗してもバトンパス自体は成功させる
-                
-                return JsonResponse({
-                    'success': True,
-                    'username': to_user.username
-                })
-            else:
+            if not form.is_valid():
                 # フォームエラー
                 errors = form.errors.get('to_user', ['入力内容に誤りがあります'])
                 return JsonResponse({
                     'success': False,
                     'error': errors[0] if errors else '入力内容に誤りがあります'
                 })
+            
+            data = {
+                'success': bool(passed),
+                'username': '、'.join(passed),
+                'results': results,
+            }
+            if not passed:
+                data['error'] = failed[0]['error']
+            return JsonResponse(data)
         
         # 通常のPOSTリクエスト（フォールバック）
-        if form.is_valid():
-            to_user = form.cleaned_data['to_user']
-            
-            if to_user != request.user:
-                Baton.objects.create(
-                    page=page,
-                    from_user=request.user,
-                    to_user=to_user
-                )
-                return redirect('page_viewer', page_id=page.id)
+        if passed:
+            return redirect('page_viewer', page_id=page.id)
+        for result in failed:
+            form.add_error('to_user', f"{result['username']}: {result['error']}")
     else:
         form = BatonPassForm()
     
-    return render(request, 'manga/pass_baton.html', {
+    return await sync_to_async(render)(request, 'manga/pass_baton.html', {
         'form': form,
         'page': page,
     })
 
+
+def _my_pages_page(request):
+    """自分が描いたページを新しい順に1ページ分取得"""
+    pages = Page.objects.filter(author=request.user).select_related('manga')
+    return paginate_keyset(
+        pages, request.GET.get('cursor'), settings.MY_PAGE_PAGE_SIZE, 'created_at'
+    )
+
+
+def _baton_groups_page(request, completed):
+    """
+    受け取ったバトンをページごとにまとめ、最後に受け取った順に1ページ分取得する
+    まとめるのはDB（GROUP BY page）で行い、表示する分のページだけを読む
+    """
+    received = Baton.objects.filter(to_user=request.user, is_completed=completed)
+    latest_sender = (
+        received.filter(page=OuterRef('page'))
+        .order_by('-created_at', '-id')
+        .values('from_user__username')[:1]
+    )
+    groups = received.values('page').annotate(
+        count=Count('id'),
+        latest_date=Max('created_at'),
+        first_sender=Subquery(latest_sender),
+    )
+    groups, next_cursor = paginate_keyset(
+        groups, request.GET.get('cursor'), settings.BATON_LIST_PAGE_SIZE,
+        'latest_date', id_field='page',
+    )
+
+    pages = Page.objects.select_related('manga').in_bulk([group['page'] for group in groups])
+    for group in groups:
+        group['page'] = pages[group['page']]
+    return groups, next_cursor
+
+
 @login_required
 def my_page(request):
-    """マイページ"""
+    """マイページ（受け取ったバトンはタブを開いたときに my_batons_json から読み込む）"""
     user = request.user
     
-    # 自分が描いたページ
-    my_pages = Page.objects.filter(author=user).select_related('manga').order_by('-created_at')
-    
-    # 未達成バトンをページごとにグループ化
-    pending_batons_raw = Baton.objects.filter(
-        to_user=user,
-        is_completed=False
-    ).select_related('page__manga', 'from_user').order_by('-created_at')
-    
-    # ページIDごとにグループ化
-    pending_grouped = {}
-    for baton in pending_batons_raw:
-        page_id = baton.page.id
-        if page_id not in pending_grouped:
-            pending_grouped[page_id] = {
-                'page': baton.page,
-                'senders': [],
-                'latest_date': baton.created_at,
-                'count': 0
-            }
-        pending_grouped[page_id]['senders'].append(baton.from_user.username)
-        pending_grouped[page_id]['count'] += 1
-        if baton.created_at > pending_grouped[page_id]['latest_date']:
-            pending_grouped[page_id]['latest_date'] = baton.created_at
-    
-    # リスト形式に変換
-    pending_batons = []
-    for group_data in pending_grouped.values():
-        pending_batons.append({
-            'page': group_data['page'],
-            'first_sender': group_data['senders'][0],
-            'count': group_data['count'],
-            'latest_date': group_data['latest_date']
-        })
-    
-    # 最新順にソート
-    pending_batons.sort(key=lambda x: x['latest_date'], reverse=True)
-    
-    # 達成済みバトンをページごとにグループ化
-    completed_batons_raw = Baton.objects.filter(
-        to_user=user,
-        is_completed=True
-    ).select_related('page__manga', 'from_user').order_by('-created_at')
-    
-    # ページIDごとにグループ化
-    completed_grouped = {}
-    for baton in completed_batons_raw:
-        page_id = baton.page.id
-        if page_id not in completed_grouped:
-            completed_grouped[page_id] = {
-                'page': baton.page,
-                'senders': [],
-                'latest_date': baton.created_at,
-                'count': 0
-            }
-        completed_grouped[page_id]['senders'].append(baton.from_user.username)
-        completed_grouped[page_id]['count'] += 1
-        if baton.created_at > completed_grouped[page_id]['latest_date']:
-            completed_grouped[page_id]['latest_date'] = baton.created_at
-    
-    # リスト形式に変換
-    completed_batons = []
-    for group_data in completed_grouped.values():
-        completed_batons.append({
-            'page': group_data['page'],
-            'first_sender': group_data['senders'][0],
-            'count': group_data['count'],
-            'latest_date': group_data['latest_date']
-        })
-    
-    # 最新順にソート
-    completed_batons.sort(key=lambda x: x['latest_date'], reverse=True)
+    # 自分が描いたページ（続きは無限スクロールで読み込む）
+    my_pages, next_cursor = _my_pages_page(request)
     
     # プロフィールフォーム
     profile, created = UserProfile.objects.get_or_create(user=user)
@@ -546,12 +488,50 @@ def my_page(request):
     
     return render(request, 'manga/my_page.html', {
         'my_pages': my_pages,
-        'pending_batons': pending_batons,
-        'completed_batons': completed_batons,
+        'next_cursor': next_cursor,
         'profile_form': profile_form,
         'username_form': username_form,
     })
 
+
+@login_required
+def my_pages_json(request):
+    """マイページの「描いたページ」の続き"""
+    pages, next_cursor = _my_pages_page(request)
+    data = [
+        {
+            "id": page.id,
+            "url": reverse('page_viewer', args=[page.id]),
+            "title": page.display_title,
+            "manga_title": page.manga.title,
+            "image": page.image.url,
+            "created_at": timezone.localtime(page.created_at).strftime('%Y/%m/%d %H:%M'),
+        }
+        for page in pages
+    ]
+    return JsonResponse({"pages": data, "next_cursor": next_cursor})
+
+
+@login_required
+def my_batons_json(request):
+    """マイページの「受け取ったバトン」（status=pending なら未達成、completed なら達成済み）"""
+    completed = request.GET.get('status') == 'completed'
+    groups, next_cursor = _baton_groups_page(request, completed)
+    data = [
+        {
+            "page_id": group['page'].id,
+            "page_title": group['page'].display_title,
+            "manga_title": group['page'].manga.title,
+            "viewer_url": reverse('page_viewer', args=[group['page'].id]),
+            "continue_url": reverse('continue_page', args=[group['page'].id]),
+            "first_sender": group['first_sender'],
+            "count": group['count'],
+            "latest_date": timezone.localtime(group['latest_date']).strftime('%Y/%m/%d %H:%M'),
+        }
+        for group in groups
+    ]
+    return JsonResponse({"batons": data, "next_cursor": next_cursor})
+
 # ========== 認証関連 ==========
 
 class CustomLoginView(LoginView):
@@ -586,10 +566,6 @@ def signup(request):
 from django.views.decorators.http import require_POST
 from django.http import JsonResponse
 from django.conf import settings
-from openai import OpenAI
-import base64
-import urllib.request
-import io
 import logging
 
 logger = logging.getLogger(__name__)
@@ -598,108 +574,103 @@ logger = logging.getLogger(__name__)
 @require_POST
 def generate_page_with_ai(request, parent_id):
     """
-    AI画像生成API
+    AI画像生成ジョブの登録API（生成はワーカーが行い、job_id をすぐに返す）
     use_reference=trueの場合は前のページ画像を参考にする
+    stream=trueの場合は部分画像を events_url（SSE）で受け取れる
+    fresh=trueの場合は同じ内容の生成結果があっても作り直す
+    candidates で候補の枚数（1〜AI_MAX_CANDIDATES）を指定できる（2枚以上のときは stream は使えない）
     """
+    parent = get_object_or_404(Page, id=parent_id)
+    prompt = request.POST.get('prompt', '')
+    use_reference = request.POST.get('use_reference', 'false') == 'true'
+    stream = request.POST.get('stream', 'false') == 'true'
+    fresh = request.POST.get('fresh', 'false') == 'true'
     try:
-        parent = get_object_or_404(Page, id=parent_id)
-        prompt = request.POST.get('prompt', '')
-        use_reference = request.POST.get('use_reference', 'false') == 'true'
-        
-        if not prompt:
-            return JsonResponse({
-                'success': False,
-                'error': 'プロンプトを入力してください'
-            }, status=400)
-        
-        # OpenAI APIキーのチェック
-        if not settings.OPENAI_API_KEY:
-            return JsonResponse({
-                'success': False,
-                'error': 'OpenAI APIキーが設定されていません'
-            }, status=500)
-        
-        # OpenAIクライアントの初期化
-        client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        
-        logger.info(f"AI画像生成開始: parent_id={parent_id}, prompt={prompt}, use_reference={use_reference}")
-        
-        # プロンプトの構築
-        full_prompt = f"""これは漫画の続きのページです。
-前のページの続きとして自然につながるように描いてください。
+        candidates = int(request.POST.get('candidates', 1))
+    except ValueError:
+        candidates = 1
+    candidates = min(max(candidates, 1), settings.AI_MAX_CANDIDATES)
+    stream = stream and candidates == 1
 
-ユーザーの指示: {prompt}
-
-要件:
-- 正方形の画像（1024x1024px）
-- マンガ風のスタイル
-- 前のページの画風や連続性を保つ
-- セリフやテキストは含めない（吹き出しの枠だけはOK）"""
-        
-        if use_reference:
-            # 前のページ画像を参考にする（Edit API）
-            parent_image_url = parent.image.url
-            
-            # Cloudinary URLの場合は絶対URLに変換
-            if not parent_image_url.startswith('http'):
-                parent_image_url = request.build_absolute_uri(parent_image_url)
-            
-            logger.info(f"参照画像URL: {parent_image_url}")
-            
-            # 画像をダウンロード
-            with urllib.request.urlopen(parent_image_url) as response:
-                image_data = response.read()
-            
-            # バイト形式で用意
-            image_file = io.BytesIO(image_data)
-            image_file.name = 'reference.png'
-            
-            # Edit APIで生成（前のページを参考）
-            response = client.images.edit(
-                model="gpt-image-1.5",
-                image=[image_file],
-                prompt=full_prompt,
-                size="1024x1024",
-                quality="high",
-                input_fidelity="high",  # 高精度で参照
-            )
-        else:
-            # 通常の生成（Generation API）
-            response = client.images.generate(
-                model="gpt-image-1.5",
-                prompt=full_prompt,
-                size="1024x1024",
-                quality="high",
-            )
-        
-        # 生成された画像のbase64データを取得
-        image_base64 = response.data[0].b64_json
-        
-        logger.info(f"AI画像生成成功")
-        
+    if not prompt:
         return JsonResponse({
-            'success': True,
-            'image_data': f'data:image/png;base64,{image_base64}',
-            'message': 'AI画像生成が完了しました'
-        })
-        
-    except Exception as e:
-        error_message = str(e)
-        logger.error(f"AI画像生成エラー: {error_message}", exc_info=True)
-        
-        # よくあるエラーの日本語化
-        user_message = 'エラーが発生しました'
-        
-        if 'safety system' in error_message:
-            user_message = 'プロンプトに不適切な単語が含まれています。修正してやり直してください。'
-        elif 'rate_limit' in error_message.lower():
-            user_message = 'APIのレート制限に達しました。しばらく待ってから再試行してください。'
-        elif 'timeout' in error_message.lower():
-            user_message = 'タイムアウトしました。もう一度試してください。'
-        else:
-            user_message = f'エラーが発生しました。サイト管理者に伝えてください: {error_message}'
-        
+            'success': False,
+            'error': 'プロンプトを入力してください'
+        }, status=400)
+
+    # OpenAI APIキーのチェック（FakeBackend では不要）
+    if not ai.get_backend().available():
         return JsonResponse({
             'success': False,
-            'error': user_message
-        }, status=500)
\ No newline at end of file
+            'error': 'OpenAI APIキーが設定されていません'
+        }, status=500)
+
+    reference_url = ""
+    if use_reference:
+        reference_url = parent.image.url
+        # Cloudinary URLの場合は絶対URLに変換（ワーカーにはリクエストがないのでここで決める）
+        if not reference_url.startswith('http'):
+            reference_url = request.build_absolute_uri(reference_url)
+
+    # 同じ内容のジョブが進行中・完了済みなら、新しく生成せずにそれを返す（fresh=true で作り直す）
+    key = ai.dedup_key(parent.id, prompt, reference_url, candidates)
+    with admission.cache_lock(f"ai:submit:{request.user.id}:{key}"):
+        job = None if fresh else ai.find_duplicate(request.user, parent, key)
+        reused = job is not None
+        if job is None:
+            # 使いすぎのユーザーは、ジョブを積む前に断る
+            rejection = admission.admit(request.user, ai.pending_count(request.user), candidates)
+            if rejection is not None:
+                message, retry_after = rejection
+                response = JsonResponse({
+                    'success': False,
+                    'error': message,
+                    'retry_after': retry_after,
+                }, status=429)
+                if retry_after:
+                    response['Retry-After'] = str(retry_after)
+                return response
+
+            job = ai.enqueue(
+                request.user, parent, prompt, use_reference, reference_url, stream, key, candidates
+            )
+            logger.info(
+                f"AI画像生成ジョブ登録: job={job.id}, parent_id={parent_id}, "
+                f"use_reference={use_reference}, candidates={candidates}"
+            )
+
+    data = {
+        **ai.job_status(job),
+        'job_id': job.id,
+        'reused': reused,
+        'status_url': reverse('ai_job_status', args=[job.id]),
+    }
+    if stream:
+        data['events_url'] = reverse('ai_job_events', args=[job.id])
+    return JsonResponse(data, status=200 if reused else 202)
+
+
+@login_required
+async def ai_job_status(request, job_id):
+    """AI画像生成ジョブの進捗と結果（ポーリングされるので非同期ビューにしている）"""
+    user = await request.auser()
+    job = await aget_object_or_404(AIGenerationJob, id=job_id, user=user)
+    return JsonResponse(await sync_to_async(ai.job_status)(job))
+
+
+@login_required
+async def ai_job_events(request, job_id):
+    """AI画像生成ジョブの進捗と部分画像を Server-Sent Events で流す"""
+    user = await request.auser()
+    job = await aget_object_or_404(AIGenerationJob, id=job_id, user=user)
+    try:
+        sent_frames = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        sent_frames = 0
+
+    # WSGI（runserver・gthread）では同期のジェネレータでないと1通ずつ送られない
+    events = ai.ajob_events if isinstance(request, ASGIRequest) else ai.job_events
+    response = StreamingHttpResponse(events(job.id, sent_frames), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # プロキシでバッファさせない
+    return response
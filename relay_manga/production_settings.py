@@ -12,7 +12,8 @@ ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', '').split(',')
 DATABASES = {
     'default': dj_database_url.config(
         default=os.environ.get('DATABASE_URL'),
-        conn_max_age=600,
+        # ASGI ではリクエストごとに接続を閉じる（gthread で動かすなら 600 などにして使い回す）
+        conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', '0')),
         conn_health_checks=True,
     )
 }
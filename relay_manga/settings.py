@@ -84,6 +84,47 @@ LOGOUT_REDIRECT_URL = 'home'
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# キャッシュ設定（REDIS_URL があればプロセス間で共有できる Redis を使う）
+REDIS_URL = config('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# ページツリーのキャッシュ保持時間（秒）。ツリーが変わればバージョンで無効になる
+TREE_CACHE_TIMEOUT = config('TREE_CACHE_TIMEOUT', default=60 * 60, cast=int)
+# プロセスごとにメモリに置いておくページツリーの合計ページ数（超えたら使われていないマンガから捨てる）
+TREE_LOCAL_CACHE_PAGES = config('TREE_LOCAL_CACHE_PAGES', default=100000, cast=int)
+
+# ページ数がこれを超えるマンガは、ビューアのツリービューで現在ページの上下数段だけを送る
+TREE_WINDOW_THRESHOLD = config('TREE_WINDOW_THRESHOLD', default=300, cast=int)
+TREE_WINDOW_LEVELS = config('TREE_WINDOW_LEVELS', default=3, cast=int)
+
+# 1回のバトンパスで渡せる人数の上限
+BATON_MAX_RECIPIENTS = config('BATON_MAX_RECIPIENTS', default=20, cast=int)
+# ヘッダーに出す未達成バトン数をキャッシュしておく時間（秒）。バトンが変われば数え直す
+PENDING_BATON_CACHE_TIMEOUT = config('PENDING_BATON_CACHE_TIMEOUT', default=60 * 5, cast=int)
+
+# マンガ一覧の1回あたりの表示件数（続きは無限スクロールで読み込む）
+MANGA_LIST_PAGE_SIZE = config('MANGA_LIST_PAGE_SIZE', default=24, cast=int)
+# マイページの「描いたページ」と「受け取ったバトン」の1回あたりの表示件数
+MY_PAGE_PAGE_SIZE = config('MY_PAGE_PAGE_SIZE', default=24, cast=int)
+BATON_LIST_PAGE_SIZE = config('BATON_LIST_PAGE_SIZE', default=20, cast=int)
+
+# うぃーねをDBへまとめて反映する間隔（秒）。0 ならクリックごとに即時反映
+LIKE_FLUSH_INTERVAL = config('LIKE_FLUSH_INTERVAL', default=5, cast=float)
+# 二重うぃーね判定をキャッシュで覚えておく時間（秒）。切れた後はうぃーね記録で判定する
+LIKE_DEDUP_TIMEOUT = config('LIKE_DEDUP_TIMEOUT', default=60 * 60 * 24, cast=int)
+
 # Cloudinary設定
 CLOUDINARY_STORAGE = {
     'CLOUD_NAME': config('CLOUDINARY_CLOUD_NAME'),
@@ -113,9 +154,65 @@ else:
 
 DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='noreply@relay-manga.com')
 
+# メールの送信（manga/outbox.py、python manage.py send_emails が送る）
+# 送信待ちを確認する間隔（秒）と、1回に取り出す件数
+EMAIL_SEND_INTERVAL = config('EMAIL_SEND_INTERVAL', default=10, cast=float)
+EMAIL_BATCH_SIZE = config('EMAIL_BATCH_SIZE', default=50, cast=int)
+# 同じ宛先へのバトンを1通にまとめるために待つ時間（秒）
+EMAIL_DIGEST_WINDOW = config('EMAIL_DIGEST_WINDOW', default=60, cast=int)
+# 送れなかったときの再送（EMAIL_RETRY_DELAY 秒から倍々に待ち、EMAIL_MAX_ATTEMPTS 回で諦める）
+EMAIL_RETRY_DELAY = config('EMAIL_RETRY_DELAY', default=60, cast=int)
+EMAIL_MAX_ATTEMPTS = config('EMAIL_MAX_ATTEMPTS', default=5, cast=int)
+# 送信中のまま、この秒数を過ぎたら送り直す（送信プロセスが落ちた場合）
+EMAIL_SEND_TIMEOUT = config('EMAIL_SEND_TIMEOUT', default=300, cast=int)
+
 # OpenAI API設定
 OPENAI_API_KEY = config('OPENAI_API_KEY', default='')
 
+# AI画像生成のバックエンド（manga/ai_backends.py）
+# 負荷試験・開発では 'manga.ai_backends.FakeBackend' にすると OpenAI を呼ばずに決まった画像を返す
+AI_BACKEND = config('AI_BACKEND', default='manga.ai_backends.OpenAIBackend')
+# FakeBackend の1件あたりの生成時間（秒）と失敗する割合（0〜1）
+AI_FAKE_LATENCY = config('AI_FAKE_LATENCY', default=5, cast=float)
+AI_FAKE_FAILURE_RATE = config('AI_FAKE_FAILURE_RATE', default=0, cast=float)
+# 下書きの置き場所（manga/draft_stores.py）。空ならバックエンドに合わせる
+# （OpenAIBackend は Cloudinary、FakeBackend は MEDIA_ROOT）
+AI_DRAFT_STORE = config('AI_DRAFT_STORE', default='')
+
+# AI画像生成ワーカー（python manage.py run_ai_worker）
+# 同時に生成するジョブ数・キューを確認する間隔（秒）・running のまま失敗扱いにするまでの時間（秒）
+AI_WORKER_CONCURRENCY = config('AI_WORKER_CONCURRENCY', default=2, cast=int)
+AI_WORKER_POLL_INTERVAL = config('AI_WORKER_POLL_INTERVAL', default=1, cast=float)
+AI_JOB_TIMEOUT = config('AI_JOB_TIMEOUT', default=60 * 10, cast=int)
+# AI画像生成の受付制御（manga/admission.py）
+# 全ワーカー合計の同時生成数・1ユーザーが同時に生成できる数・1ユーザーが待たせておける数
+AI_MAX_CONCURRENT = config('AI_MAX_CONCURRENT', default=4, cast=int)
+AI_MAX_RUNNING_PER_USER = config('AI_MAX_RUNNING_PER_USER', default=1, cast=int)
+AI_MAX_QUEUED_PER_USER = config('AI_MAX_QUEUED_PER_USER', default=3, cast=int)
+# ユーザーごとの回数制限（AI_USER_BURST 回まで連続で使え、1時間に AI_USER_RATE_PER_HOUR 回分回復する）
+AI_USER_BURST = config('AI_USER_BURST', default=5, cast=int)
+AI_USER_RATE_PER_HOUR = config('AI_USER_RATE_PER_HOUR', default=20, cast=float)
+# 全体で上流APIに送る1分あたりの生成数（0 なら制限しない）
+AI_GLOBAL_RATE_PER_MINUTE = config('AI_GLOBAL_RATE_PER_MINUTE', default=10, cast=float)
+# 実績がないときに使う1件あたりの生成時間の目安（秒）
+AI_DEFAULT_DURATION = config('AI_DEFAULT_DURATION', default=60, cast=int)
+# 参照画像（前のページ）をワーカーのメモリに置いておく上限（バイト）と、取得のタイムアウト（秒）
+AI_REFERENCE_CACHE_BYTES = config('AI_REFERENCE_CACHE_BYTES', default=64 * 1024 * 1024, cast=int)
+AI_REFERENCE_TIMEOUT = config('AI_REFERENCE_TIMEOUT', default=30, cast=float)
+# 同じ内容の生成リクエストに、完了済みの結果を返す期間（秒）
+AI_RESULT_CACHE_TTL = config('AI_RESULT_CACHE_TTL', default=60 * 60, cast=int)
+# 1回の生成で作れる候補の枚数の上限（上流APIへは1回のリクエストでまとめて頼む）
+AI_MAX_CANDIDATES = config('AI_MAX_CANDIDATES', default=4, cast=int)
+# ユーザーごとに残しておく、ページに使われていない下書きの数（古いものから消す）
+AI_MAX_DRAFTS_PER_USER = config('AI_MAX_DRAFTS_PER_USER', default=20, cast=int)
+# ページに使われなかったAI生成画像（下書き）を残しておく時間（秒）
+AI_DRAFT_TTL = config('AI_DRAFT_TTL', default=60 * 60 * 24, cast=int)
+# ストリーミング生成で受け取る部分画像の枚数（0〜3）
+AI_PARTIAL_IMAGES = config('AI_PARTIAL_IMAGES', default=2, cast=int)
+# SSE でジョブを確認する間隔（秒）と、1本の接続を保つ最長時間（秒、過ぎたらブラウザが再接続する）
+AI_STREAM_POLL_INTERVAL = config('AI_STREAM_POLL_INTERVAL', default=0.5, cast=float)
+AI_STREAM_MAX_SECONDS = config('AI_STREAM_MAX_SECONDS', default=25, cast=int)
+
 # 本番環境設定の読み込み
 if os.environ.get('RENDER'):
     from .production_settings import *
\ No newline at end of file